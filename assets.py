@@ -0,0 +1,153 @@
+# assets.py
+# Общий на все боты процесса кэш файлов лид-магнитов и их file_id в Telegram
+
+import os
+import json
+import tempfile
+import threading
+from collections import OrderedDict
+
+from config import ASSET_CACHE_MAX_MB
+
+
+FILE_IDS_NAME = "file_ids.json"
+
+
+class AssetCache:
+    """
+    Кэш лид-магнитов:
+        - содержимое файлов (один PDF, выданный разными ботами, читается
+          с диска один раз), вытеснение по LRU в пределах max_bytes;
+        - file_id, который Telegram вернул после загрузки. file_id привязан
+          к боту, поэтому ключ — (имя бота, путь). Повторная выдача того же
+          файла идёт по file_id, без повторной загрузки. file_id сохраняются
+          в data/file_ids.json бота (атомарно, как users.json) и переживают
+          перезапуск процесса по cron.
+
+    Записи привязаны к mtime/размеру файла: заменили файл на диске — кэш
+    его больше не отдаёт.
+    """
+
+    def __init__(self, max_bytes: int = ASSET_CACHE_MAX_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._blobs = OrderedDict()  # path -> (signature, bytes)
+        self._blob_bytes = 0
+        self._file_ids = {}  # (bot_name, path) -> (signature, file_id)
+        self._loaded = set()  # боты, чьи file_ids.json уже прочитаны
+
+    @staticmethod
+    def _signature(path: str):
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size
+
+    def read(self, path: str) -> bytes:
+        """Содержимое файла (из памяти, если файл не менялся)."""
+        signature = self._signature(path)
+        with self._lock:
+            cached = self._blobs.get(path)
+            if cached and cached[0] == signature:
+                self._blobs.move_to_end(path)
+                return cached[1]
+
+        with open(path, "rb") as f:
+            data = f.read()
+
+        with self._lock:
+            old = self._blobs.pop(path, None)
+            if old:
+                self._blob_bytes -= len(old[1])
+            if len(data) <= self.max_bytes:
+                self._blobs[path] = (signature, data)
+                self._blob_bytes += len(data)
+                while self._blob_bytes > self.max_bytes:
+                    _, (_, evicted) = self._blobs.popitem(last=False)
+                    self._blob_bytes -= len(evicted)
+        return data
+
+    # --- file_id ---
+
+    @staticmethod
+    def _file_ids_path(profile) -> str:
+        return os.path.join(profile.data_dir, FILE_IDS_NAME)
+
+    @staticmethod
+    def _read_file_ids(path: str) -> dict:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception:
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def _load_locked(self, profile):
+        if profile.name in self._loaded:
+            return
+        self._loaded.add(profile.name)
+        for path, item in self._read_file_ids(self._file_ids_path(profile)).items():
+            try:
+                signature = (int(item["mtime_ns"]), int(item["size"]))
+                file_id = str(item["file_id"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            self._file_ids.setdefault((profile.name, path), (signature, file_id))
+
+    def _save_locked(self, profile):
+        """
+        Пишет file_id бота в data/file_ids.json: во временный файл рядом,
+        затем os.replace.
+        """
+        data = {}
+        for (bot_name, path), (signature, file_id) in self._file_ids.items():
+            if bot_name == profile.name:
+                data[path] = {"mtime_ns": signature[0], "size": signature[1], "file_id": file_id}
+
+        tmp_path = None
+        try:
+            os.makedirs(profile.data_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(prefix=".file_ids-", suffix=".tmp", dir=profile.data_dir)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self._file_ids_path(profile))
+            tmp_path = None
+        except Exception:
+            pass
+        finally:
+            if tmp_path:
+                try:
+                    os.remove(tmp_path)
+                except Exception:
+                    pass
+
+    def get_file_id(self, profile, path: str):
+        try:
+            signature = self._signature(path)
+        except OSError:
+            return None
+        with self._lock:
+            self._load_locked(profile)
+            cached = self._file_ids.get((profile.name, path))
+        if cached and cached[0] == signature:
+            return cached[1]
+        return None
+
+    def remember_file_id(self, profile, path: str, file_id: str):
+        try:
+            signature = self._signature(path)
+        except OSError:
+            return
+        with self._lock:
+            self._load_locked(profile)
+            if self._file_ids.get((profile.name, path)) == (signature, file_id):
+                return
+            self._file_ids[(profile.name, path)] = (signature, file_id)
+            self._save_locked(profile)
+
+    def forget_file_id(self, profile, path: str):
+        with self._lock:
+            self._load_locked(profile)
+            if self._file_ids.pop((profile.name, path), None) is not None:
+                self._save_locked(profile)
+
+
+ASSET_CACHE = AssetCache()
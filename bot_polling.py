@@ -3,10 +3,12 @@
 
 import os
 import time
+import signal
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 from telegram import (
-    Bot,
     Update,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
@@ -17,9 +19,17 @@ from telegram.ext import (
     CallbackQueryHandler,
     CallbackContext,
 )
-
-from config import BOT_TOKEN, CHANNEL_ID, get_lead_file_path
-from config import FREE_URL, BASE_URL, PRO_URL
+from telegram.error import BadRequest, TelegramError
+
+from config import get_lead_file_path, current_profile, load_profiles, use_profile
+from config import LIVE_STATS_ENABLED, USER_INDEX_ENABLED, BOT_WORKERS, BOT_HTTP_POOL_SIZE
+from config import CHURN_ENABLED, CHURN_CONCURRENCY, PROFILE_NEXT_UPDATES
+from assets import ASSET_CACHE
+from tg_client import TelegramClient, TelegramUnavailable, make_bot, make_request
+from live_stats import LiveStats
+from user_index import UserEventIndex
+from churn_check import start_churn_thread
+from flight_recorder import RECORDER, SLOW_UPDATES_DIR, span, traced
 from storage import (
     update_user,
     log_event,
@@ -35,17 +45,17 @@ def _ts():
     return time.strftime("%Y-%m-%dT%H:%M:%S")
 
 
-def check_config():
+def check_config(profile):
     """
     Быстрая проверка критичных настроек, чтобы не гонять бота без токена/канала.
     """
     missing = []
-    if not BOT_TOKEN:
+    if not profile.token:
         missing.append("BOT_TOKEN")
-    if not CHANNEL_ID:
+    if not profile.channel_id:
         missing.append("CHANNEL_ID")
     if missing:
-        print(f"[{_ts()}] Ошибка конфигурации: отсутствуют {', '.join(missing)}")
+        print(f"[{_ts()}] Ошибка конфигурации бота {profile.name}: отсутствуют {', '.join(missing)}")
         return False
     return True
 
@@ -82,9 +92,57 @@ def parse_start_param(param: str):
     return platform, theme, lead_type, creative
 
 
+def _client(context: CallbackContext) -> TelegramClient:
+    """Клиент Telegram API бота, обрабатывающего апдейт."""
+    return context.bot_data["tg"]
+
+
+def _answer(tg: TelegramClient, query, text: str = None):
+    """
+    Отвечает на callback (убирает «часики» на кнопке). Ошибка здесь не
+    должна прерывать обработку: ответ косметический, а у старых callback
+    Telegram его уже не принимает.
+    """
+    try:
+        tg.call("answer_callback_query", query.answer, text)
+    except (TelegramError, TelegramUnavailable):
+        pass
+
+
+@traced("resolve_subscription")
+def resolve_subscription(tg: TelegramClient, channel_id: str, user_id: int):
+    """
+    Статус подписки с учётом кэша (30 минут).
+
+    Возвращает True/False или None, если статус узнать не удалось и о
+    пользователе ничего не известно. False — только явный ответ left/kicked.
+    Если API недоступен или ответил ошибкой без статуса (бот потерял права
+    в канале, чат не найден и т.п.), отдаём последний известный статус
+    (даже с истёкшим TTL) и кэш не перезаписываем — иначе ошибка канала
+    на 30 минут записала бы всех в «не подписан».
+    """
+    cached = get_cached_subscription(user_id)
+    if cached is not None:
+        return cached
+
+    try:
+        is_member = tg.membership(channel_id, user_id)
+    except TelegramUnavailable:
+        return get_cached_subscription(user_id, allow_stale=True)
+    except TelegramError as e:
+        print(f"[{_ts()}] get_chat_member {channel_id}: {e}")
+        return get_cached_subscription(user_id, allow_stale=True)
+    if is_member is None:
+        return get_cached_subscription(user_id, allow_stale=True)
+
+    cache_subscription_status(user_id, is_member)
+    return is_member
+
+
 # --- Обработчики команд и кнопок ---
 
 def start(update: Update, context: CallbackContext):
+    profile = current_profile()
     user = update.effective_user
     chat_id = update.effective_chat.id
 
@@ -129,7 +187,7 @@ def start(update: Update, context: CallbackContext):
         [
             InlineKeyboardButton(
                 "📢 Подписаться на канал",
-                url=f"https://t.me/{CHANNEL_ID.lstrip('@')}",
+                url=f"https://t.me/{profile.channel_id.lstrip('@')}",
             )
         ],
         [
@@ -141,40 +199,38 @@ def start(update: Update, context: CallbackContext):
     ])
 
     if update.message:
-        update.message.reply_text(text, reply_markup=keyboard)
+        _client(context).call("send_message", update.message.reply_text, text, reply_markup=keyboard)
 
 
 def check_subscription(update: Update, context: CallbackContext):
+    profile = current_profile()
+    tg = _client(context)
     query = update.callback_query
     user = query.from_user
-    query.answer()
+    _answer(tg, query)
 
-    # Проверяем подписку с учётом кэша (30 минут)
-    cached = get_cached_subscription(user.id)
-    if cached is not None:
-        is_member = cached
-    else:
-        is_member = False
-        try:
-            member = context.bot.get_chat_member(CHANNEL_ID, user.id)
-            if member.status in ("member", "administrator", "creator"):
-                is_member = True
-        except Exception:
-            is_member = False
-        cache_subscription_status(user.id, is_member)
+    is_member = resolve_subscription(tg, profile.channel_id, user.id)
 
     if not is_member:
-        # Не подписан — снова даём кнопки
-        text = (
-            "Похоже, ты ещё не подписан на канал.\n\n"
-            "Подпишись, пожалуйста, чтобы получить доступ к материалам.\n\n"
-            "После подписки нажми «✅ Уже подписался — выдать файл»."
-        )
+        if is_member is None:
+            # Статус не узнать (перебои Telegram, ошибка канала), а прошлого нет
+            text = (
+                "Не получилось проверить подписку — Telegram сейчас отвечает "
+                "с перебоями.\n\n"
+                "Нажми «✅ Уже подписался — выдать файл» ещё раз через минуту."
+            )
+        else:
+            # Не подписан — снова даём кнопки
+            text = (
+                "Похоже, ты ещё не подписан на канал.\n\n"
+                "Подпишись, пожалуйста, чтобы получить доступ к материалам.\n\n"
+                "После подписки нажми «✅ Уже подписался — выдать файл»."
+            )
         keyboard = InlineKeyboardMarkup([
             [
                 InlineKeyboardButton(
                     "📢 Подписаться на канал",
-                    url=f"https://t.me/{CHANNEL_ID.lstrip('@')}",
+                    url=f"https://t.me/{profile.channel_id.lstrip('@')}",
                 )
             ],
             [
@@ -186,7 +242,7 @@ def check_subscription(update: Update, context: CallbackContext):
         ])
         # Защита от ошибки "Message is not modified"
         if not query.message or query.message.text != text:
-            query.edit_message_text(text, reply_markup=keyboard)
+            tg.call("edit_message_text", query.edit_message_text, text, reply_markup=keyboard)
         return
 
     # Подписка есть — достаём данные по пользователю
@@ -199,7 +255,8 @@ def check_subscription(update: Update, context: CallbackContext):
     creative = udata.get("creative", "")
 
     # Пытаемся найти файл лид-магнита
-    lead_path = get_lead_file_path(theme, lead_type, creative)
+    with span("get_lead_file_path"):
+        lead_path = get_lead_file_path(theme, lead_type, creative)
 
     if not lead_path:
         msg = (
@@ -210,7 +267,7 @@ def check_subscription(update: Update, context: CallbackContext):
         )
         # Тут текст почти всегда отличается, но на всякий случай проверяем
         if not query.message or query.message.text != msg:
-            query.edit_message_text(msg)
+            tg.call("edit_message_text", query.edit_message_text, msg)
         log_event(
             user.id,
             "lead_file_not_found",
@@ -226,15 +283,9 @@ def check_subscription(update: Update, context: CallbackContext):
     try:
         sending_text = "Подписка подтверждена ✅\nОтправляю файл…"
         if not query.message or query.message.text != sending_text:
-            query.edit_message_text(sending_text)
-
-        with open(lead_path, "rb") as f:
-            context.bot.send_document(
-                chat_id=user.id,
-                document=f,
-                filename=lead_path.split("/")[-1],
-                caption="📎 Твой файл-лид-магнит. Сохрани себе и внедряй.",
-            )
+            tg.call("edit_message_text", query.edit_message_text, sending_text)
+
+        send_lead_document(tg, profile, user.id, lead_path)
 
         log_event(
             user.id,
@@ -253,22 +304,22 @@ def check_subscription(update: Update, context: CallbackContext):
             [
                 InlineKeyboardButton(
                     "▶️ Пройти бесплатный модуль (FREE)",
-                    url=FREE_URL or "https://stepik.org/a/252809",
+                    url=profile.free_url or "https://stepik.org/a/252809",
                 )
             ],
             [
                 InlineKeyboardButton(
                     "💼 Формат BASE",
-                    url=BASE_URL or "https://stepik.org/a/252040",
+                    url=profile.base_url or "https://stepik.org/a/252040",
                 ),
                 InlineKeyboardButton(
                     "⭐ Формат PRO",
-                    url=PRO_URL or "https://stepik.org/a/252823",
+                    url=profile.pro_url or "https://stepik.org/a/252823",
                 ),
             ],
         ])
 
-        context.bot.send_message(
+        tg.send_message(
             chat_id=user.id,
             text=(
                 "Если хочешь не только потушить пожар, но и выстроить систему "
@@ -281,12 +332,41 @@ def check_subscription(update: Update, context: CallbackContext):
 
     except Exception:
         traceback.print_exc()
-        query.edit_message_text(
+        tg.call(
+            "edit_message_text",
+            query.edit_message_text,
             "Произошла ошибка при отправке файла.\n"
-            "Попробуй позже или напиши Алексею Бородулину."
+            "Попробуй позже или напиши Алексею Бородулину.",
         )
 
 
+@traced("send_lead_document")
+def send_lead_document(tg: TelegramClient, profile, chat_id: int, lead_path: str):
+    """
+    Отправляет файл лид-магнита. Если этот бот уже загружал файл, шлём его
+    по file_id (без повторной загрузки), иначе — содержимое из общего
+    кэша ASSET_CACHE и запоминаем полученный file_id.
+    """
+    caption = "📎 Твой файл-лид-магнит. Сохрани себе и внедряй."
+    file_id = ASSET_CACHE.get_file_id(profile, lead_path)
+    if file_id:
+        try:
+            tg.send_document(chat_id=chat_id, document=file_id, caption=caption)
+            return
+        except BadRequest:
+            # file_id мог протухнуть — забываем и загружаем файл заново
+            ASSET_CACHE.forget_file_id(profile, lead_path)
+
+    message = tg.send_document(
+        chat_id=chat_id,
+        document=ASSET_CACHE.read(lead_path),
+        filename=os.path.basename(lead_path),
+        caption=caption,
+    )
+    if message and message.document:
+        ASSET_CACHE.remember_file_id(profile, lead_path, message.document.file_id)
+
+
 def button_click_logger(update: Update, context: CallbackContext):
     """
     На будущее: если будешь использовать callback_data для кнопок курсов —
@@ -296,27 +376,345 @@ def button_click_logger(update: Update, context: CallbackContext):
     query = update.callback_query
     user = query.from_user
     data = query.data or ""
-    query.answer()
+    _answer(_client(context), query)
 
     log_event(user.id, "button_click", extra=data)
 
 
-def main():
-    if not check_config():
+# --- Команда /stats для администраторов ---
+
+STATS_TOP_N = 10
+STATS_MAX_TOP_N = 30
+
+
+def _pct(part: int, whole: int) -> str:
+    return f"{part * 100 / whole:.1f}%" if whole else "—"
+
+
+def _format_stats_summary(report: dict) -> str:
+    totals = report["totals"]
+    lines = [
+        "📊 Итого",
+        f"Пользователей: {totals['users']}",
+        f"Получили лид-магнит: {totals['with_lead']} ({_pct(totals['with_lead'], totals['users'])})",
+        f"Отписались после лида: {totals['unsubscribed']}",
+        f"Событий: {totals['events']}",
+        "",
+    ]
+    (today, t), (yesterday, y) = sorted(report["days"].items(), reverse=True)
+    lines.append(f"Сегодня ({today}) / вчера ({yesterday}):")
+    for key, title in (("events", "события"), ("leads", "лиды"), ("unsubs", "отписки")):
+        diff = t[key] - y[key]
+        lines.append(f"  {title}: {t[key]} / {y[key]} ({diff:+d})")
+    return "\n".join(lines)
+
+
+def _format_stats_top(report: dict) -> str:
+    if not report["top"]:
+        return "Пока нет выдач лид-магнитов."
+    lines = ["🏆 Лучшие связки (уникальные пользователи с лидом):"]
+    for i, (key, users) in enumerate(report["top"], 1):
+        lines.append(f"{i}. {key} — {users}")
+    return "\n".join(lines)
+
+
+def _format_stats_platforms(report: dict) -> str:
+    if not report["platforms"]:
+        return "Пока нет данных по платформам."
+    lines = ["📱 Конверсия в лид по платформам:"]
+    for platform, users, leads in report["platforms"]:
+        lines.append(f"{platform}: {leads} из {users} ({_pct(leads, users)})")
+    return "\n".join(lines)
+
+
+def _is_admin(update: Update) -> bool:
+    """Команда от администратора текущего бота (admin_ids профиля)."""
+    user = update.effective_user
+    return bool(update.message) and user is not None and user.id in current_profile().admin_ids
+
+
+def admin_stats(update: Update, context: CallbackContext):
+    """
+    /stats — итоги и сегодня/вчера, /stats top [N] — лучшие связки,
+    /stats platforms — конверсия по платформам.
+
+    Только для admin_ids профиля; остальным бот молчит. Ответ строится из
+    сводки LiveStats в памяти — events.csv и stats.json не читаются.
+    """
+    if not _is_admin(update):
+        return
+
+    args = [a.lower() for a in (context.args or [])]
+    section = args[0] if args else ""
+    top_n = STATS_TOP_N
+    if section == "top" and len(args) > 1 and args[1].isdigit():
+        top_n = max(1, min(int(args[1]), STATS_MAX_TOP_N))
+
+    live = context.bot_data.get("live")
+    report = live.report(top_n) if live is not None else None
+    if report is None:
+        text = "Живая статистика выключена (LIVE_STATS_ENABLED=0) — смотрите дашборд."
+    elif section == "top":
+        text = _format_stats_top(report)
+    elif section in ("platforms", "platform"):
+        text = _format_stats_platforms(report)
+    elif section:
+        text = "Команды: /stats, /stats top [N], /stats platforms"
+    else:
+        text = _format_stats_summary(report)
+
+    _client(context).call("send_message", update.message.reply_text, text)
+
+
+def admin_profile(update: Update, context: CallbackContext):
+    """
+    /profile [N] — профилировать cProfile следующие N апдейтов (по
+    умолчанию PROFILE_NEXT_UPDATES) и сохранить последние трассы. Только
+    для admin_ids профиля. То же делает сигнал SIGUSR1 процессу бота.
+    """
+    if not _is_admin(update):
         return
 
-    updater = Updater(BOT_TOKEN, use_context=True)
+    args = context.args or []
+    n = int(args[0]) if args and args[0].isdigit() else PROFILE_NEXT_UPDATES
+    RECORDER.profile_next(n)
+    RECORDER.dump_recent()
+    folder = os.path.join(current_profile().logs_dir, SLOW_UPDATES_DIR)
+    _client(context).call(
+        "send_message",
+        update.message.reply_text,
+        f"Профилирую следующие {n} апдейтов. Трассы и профили — в {folder}",
+    )
+
+
+def _on_sigusr1(signum, frame):
+    RECORDER.profile_next(PROFILE_NEXT_UPDATES)
+    RECORDER.dump_recent()
+    print(f"[{_ts()}] SIGUSR1: профилирую следующие {PROFILE_NEXT_UPDATES} апдейтов")
+
+
+# --- Хостинг нескольких ботов в одном процессе ---
+
+# Сколько апдейтов забирать одним getUpdates при разборе очереди
+# (100 — максимум, который принимает Telegram)
+BACKLOG_BATCH = 100
+
+DUPLICATE_CHECK_TEXT = "⏳ Уже проверяю подписку, секунду…"
+
+
+class PendingCallbacks:
+    """
+    user_id, у которых проверка подписки (check_sub) уже в очереди пула или
+    выполняется. Повторные нажатия за это время не запускают вторую
+    проверку — на них сразу отвечаем, чтобы кнопка не «крутилась».
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._user_ids = set()
+
+    def acquire(self, user_id: int) -> bool:
+        with self._lock:
+            if user_id in self._user_ids:
+                return False
+            self._user_ids.add(user_id)
+            return True
+
+    def release(self, user_id: int):
+        with self._lock:
+            self._user_ids.discard(user_id)
+
+
+def _answer_duplicate(pool: ThreadPoolExecutor, tg: TelegramClient, query):
+    # Ответ — сетевой вызов, поэтому не в потоке диспетчера
+    pool.submit(_answer, tg, query, DUPLICATE_CHECK_TEXT)
+
+
+def _hosted(pool: ThreadPoolExecutor, profile, handler, pending: PendingCallbacks = None):
+    """
+    Оборачивает обработчик: апдейт уходит в общий пул потоков и
+    обрабатывается в контексте профиля своего бота.
+
+    С pending обработчик callback-кнопки выполняется не больше одного раза
+    одновременно на пользователя, лишние нажатия отвечаются сразу.
+    """
+    def _run(update: Update, context: CallbackContext, user_id=None):
+        with use_profile(profile):
+            try:
+                user = update.effective_user
+                with RECORDER.trace(handler.__name__, user.id if user else None):
+                    handler(update, context)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                if user_id is not None:
+                    pending.release(user_id)
+
+    def _callback(update: Update, context: CallbackContext):
+        user_id = None
+        if pending is not None and update.callback_query:
+            user_id = update.callback_query.from_user.id
+            if not pending.acquire(user_id):
+                _answer_duplicate(pool, _client(context), update.callback_query)
+                return
+        pool.submit(_run, update, context, user_id)
+
+    return _callback
+
+
+def _setup_bot(profile, request, pool: ThreadPoolExecutor, live: LiveStats = None):
+    """
+    Собирает Updater для одного бота. Собственных потоков-обработчиков у
+    него нет (workers=0): диспетчер только раздаёт апдейты в общий пул.
+    Вызовы API из обработчиков идут через TelegramClient (bot_data["tg"]),
+    /stats отвечает из живой статистики бота (bot_data["live"]).
+    """
+    bot = make_bot(profile.token, request)
+    updater = Updater(bot=bot, workers=0, use_context=True)
     dp = updater.dispatcher
+    dp.bot_data["tg"] = TelegramClient(bot)
+    dp.bot_data["live"] = live
+
+    check_sub = _hosted(pool, profile, check_subscription, pending=PendingCallbacks())
+    dp.add_handler(CommandHandler("start", _hosted(pool, profile, start)))
+    dp.add_handler(CommandHandler("stats", _hosted(pool, profile, admin_stats)))
+    dp.add_handler(CommandHandler("profile", _hosted(pool, profile, admin_profile)))
+    dp.add_handler(CallbackQueryHandler(check_sub, pattern="^check_sub$"))
+    dp.add_handler(CallbackQueryHandler(_hosted(pool, profile, button_click_logger), pattern="^click_"))
+    return updater
+
 
-    dp.add_handler(CommandHandler("start", start))
-    dp.add_handler(CallbackQueryHandler(check_subscription, pattern="^check_sub$"))
-    dp.add_handler(CallbackQueryHandler(button_click_logger, pattern="^click_"))
+def _coalesce_check_sub(updates: list):
+    """
+    Делит очередь апдейтов на (к обработке, лишние): из нескольких нажатий
+    check_sub одного пользователя остаётся последнее (на месте последнего),
+    остальные — лишние. Прочие апдейты идут как есть, в исходном порядке.
+    """
+    last = {}
+    for update in updates:
+        query = update.callback_query
+        if query is not None and query.data == "check_sub":
+            last[query.from_user.id] = update.update_id
+
+    keep, extra = [], []
+    for update in updates:
+        query = update.callback_query
+        if query is not None and query.data == "check_sub" and last[query.from_user.id] != update.update_id:
+            extra.append(update)
+        else:
+            keep.append(update)
+    return keep, extra
+
+
+def drain_backlog(updater, pool: ThreadPoolExecutor) -> int:
+    """
+    Разбирает апдейты, накопившиеся между запусками cron, до start_polling:
+    забирает всю очередь подряд пачками по BACKLOG_BATCH без long polling,
+    схлопывает повторные check_sub и отдаёт остальное диспетчеру.
+
+    После этого updater.last_update_id указывает за последний забранный
+    апдейт, так что start_polling не получит их повторно. Возвращает число
+    забранных апдейтов.
+    """
+    tg = updater.dispatcher.bot_data["tg"]
+    updates = []
+    offset = None
+    try:
+        while True:
+            batch = tg.call("get_updates", None, offset=offset, limit=BACKLOG_BATCH, timeout=0)
+            if not batch:
+                break
+            updates.extend(batch)
+            offset = batch[-1].update_id + 1
+            if len(batch) < BACKLOG_BATCH:
+                break
+    except (TelegramError, TelegramUnavailable) as e:
+        # Уже забранное всё равно обрабатываем: очередной getUpdates с
+        # большим offset подтвердил их у Telegram
+        print(f"[{_ts()}] Очередь апдейтов разобрана не до конца: {e}")
+
+    if not updates:
+        return 0
+
+    keep, extra = _coalesce_check_sub(updates)
+    for update in extra:
+        _answer_duplicate(pool, tg, update.callback_query)
+    for update in keep:
+        updater.dispatcher.process_update(update)
+
+    updater.last_update_id = updates[-1].update_id + 1
+    return len(updates)
+
+
+def main():
+    profiles = [p for p in load_profiles() if check_config(p)]
+    if not profiles:
+        return
+
+    # kill -USR1 <pid> — профилировать следующие апдейты (см. flight_recorder.py)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, _on_sigusr1)
+
+    # Общие на все боты ресурсы: пул обработчиков и пул HTTP-соединений.
+    # На каждого бота держим одно соединение под long polling и свои
+    # соединения под фоновую перепроверку подписки.
+    pool = ThreadPoolExecutor(max_workers=BOT_WORKERS, thread_name_prefix="bot-worker")
+    per_bot = 1 + (CHURN_CONCURRENCY if CHURN_ENABLED else 0)
+    request = make_request(max(BOT_HTTP_POOL_SIZE, BOT_WORKERS + per_bot * len(profiles)))
+
+    # Живая статистика: stats.json обновляется по ходу работы бота,
+    # cron-запуск build_stats.py остаётся сверкой
+    live_stats = []
+    updaters = []
+    for profile in profiles:
+        with use_profile(profile):
+            live = None
+            if LIVE_STATS_ENABLED:
+                try:
+                    live = LiveStats()
+                    live.start()
+                    live_stats.append(live)
+                except Exception:
+                    live = None
+                    traceback.print_exc()
+            if USER_INDEX_ENABLED:
+                try:
+                    UserEventIndex().attach()
+                except Exception:
+                    traceback.print_exc()
+            updaters.append(_setup_bot(profile, request, pool, live))
+
+    # Сначала разом разбираем то, что накопилось между запусками cron,
+    # затем короткий цикл polling, чтобы дружить с cron (служит ~50 секунд)
+    for profile, updater in zip(profiles, updaters):
+        drained = drain_backlog(updater, pool)
+        if drained:
+            print(f"[{_ts()}] {profile.name}: из очереди разобрано апдейтов: {drained}")
+        updater.start_polling()
+
+    # Фоновая перепроверка подписки (churn) — в паузах между апдейтами,
+    # со своим лимитом запросов, не занимая пул обработчиков
+    churn_stop = threading.Event()
+    churn_threads = []
+    if CHURN_ENABLED:
+        for profile, updater in zip(profiles, updaters):
+            churn_threads.append(
+                start_churn_thread(profile, updater.dispatcher.bot_data["tg"], churn_stop)
+            )
 
-    # Короткий цикл polling, чтобы дружить с cron (служит ~50 секунд)
-    updater.start_polling()
     time.sleep(50)
-    updater.stop()
-    updater.is_idle = False
+    churn_stop.set()
+    for updater in updaters:
+        updater.stop()
+        updater.is_idle = False
+
+    # Дожидаемся обработчиков, которые уже взяли апдейты
+    pool.shutdown(wait=True)
+    for thread in churn_threads:
+        thread.join(timeout=15)
+
+    for live in live_stats:
+        live.stop()
 
 
 if __name__ == "__main__":
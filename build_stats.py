@@ -3,14 +3,19 @@
 
 import os
 import json
+import tempfile
 from collections import defaultdict
 from datetime import datetime
 
-from config import STATS_DIR
-from utils import read_events, read_users, safe_load_json
+from config import current_profile, load_profiles, use_profile
+from checkpoint import Checkpoint, CheckpointError, write_checkpoint
+from storage import file_lock
+from utils import EventStream, read_users, safe_load_json
 
 
-STATS_FILE = os.path.join(STATS_DIR, "stats.json")
+# Колонки events.csv, которые нужны для агрегатов (chat_id и extra не читаем)
+STATS_FIELDS = ("timestamp", "user_id", "event", "platform", "theme", "lead_type", "creative")
+
 DEFAULT_META = {
     "processed_events": 0,
     "events_by_day": {},
@@ -27,67 +32,124 @@ DEFAULT_META = {
     "leads_by_theme_users": {},
     "all_users": [],
     "users_with_lead": [],
+    "unsubs_by_day": {},
+    "users_unsubscribed": [],
 }
 
 
-def _as_set_dict(value):
-    return {k: set(v) for k, v in (value or {}).items()}
+def stats_file() -> str:
+    """Путь к stats.json текущего бота."""
+    return os.path.join(current_profile().stats_dir, "stats.json")
 
 
-def _load_prev_meta():
-    data = safe_load_json(STATS_FILE, {})
-    if not isinstance(data, dict):
-        return DEFAULT_META.copy()
-    meta = data.get("meta", {}) or {}
-    merged = DEFAULT_META.copy()
-    merged.update(meta)
-    return merged
+def checkpoint_file() -> str:
+    """Путь к чекпоинту инкрементального пересчёта (meta) текущего бота."""
+    return os.path.join(current_profile().stats_dir, "meta.ckpt")
 
 
-def build_stats():
-    prev_meta = _load_prev_meta()
-    processed_before = max(int(prev_meta.get("processed_events", 0) or 0), 0)
+def stats_lock():
+    """
+    Межпроцессная блокировка stats.json текущего бота: под ней идёт
+    чтение meta → пересчёт → запись (cron, бот, удаление пользователя).
+    """
+    return file_lock(os.path.join(current_profile().stats_dir, "stats.lock"))
 
-    events, total_rows = read_events(skip_rows=processed_before)
-    users = read_users()
 
-    # Если файл урезан/пересоздан — начинаем с нуля
-    if processed_before > total_rows:
-        processed_before = 0
-        events, total_rows = read_events(skip_rows=0)
+def _as_set_dict(value):
+    return {k: set(v) for k, v in (value or {}).items()}
 
-    # --- Базовые структуры, подхватываем прошлые значения ---
-    events_by_day = defaultdict(int, prev_meta.get("events_by_day", {}))
-    leads_by_day = defaultdict(int, prev_meta.get("leads_by_day", {}))
 
-    by_platform_events = defaultdict(int, prev_meta.get("by_platform_events", {}))
-    by_theme_events = defaultdict(int, prev_meta.get("by_theme_events", {}))
-    by_lead_type_events = defaultdict(int, prev_meta.get("by_lead_type_events", {}))
-    by_creative_events = defaultdict(int, prev_meta.get("by_creative_events", {}))
+def _load_prev_meta():
+    """
+    Состояние прошлого пересчёта. Обычно — бинарный чекпоинт
+    stats/meta.ckpt (Checkpoint: секции разбираются по мере обращения).
+    Если чекпоинта ещё нет или он не прошёл проверку — meta из stats.json
+    старого формата: после первого же пересчёта она переезжает в чекпоинт.
+    Если нет и её — пустое состояние (полный пересчёт).
+    """
+    path = checkpoint_file()
+    if os.path.isfile(path):
+        try:
+            return Checkpoint(path)
+        except (CheckpointError, OSError):
+            pass
 
-    by_platform_users = defaultdict(set, _as_set_dict(prev_meta.get("by_platform_users")))
-    by_theme_users = defaultdict(set, _as_set_dict(prev_meta.get("by_theme_users")))
-    by_lead_type_users = defaultdict(set, _as_set_dict(prev_meta.get("by_lead_type_users")))
-    by_creative_users = defaultdict(set, _as_set_dict(prev_meta.get("by_creative_users")))
+    merged = DEFAULT_META.copy()
+    data = safe_load_json(stats_file(), {})
+    if not isinstance(data, dict) or not isinstance(data.get("meta"), dict):
+        return merged
+    merged.update(data["meta"])
+    return merged
 
-    creative_users_full_key = defaultdict(set, _as_set_dict(prev_meta.get("creative_users_full_key")))
-    leads_by_theme_users = defaultdict(set, _as_set_dict(prev_meta.get("leads_by_theme_users")))
 
-    all_users = set(prev_meta.get("all_users", []))
-    users_with_lead = set(prev_meta.get("users_with_lead", []))
+def _state_from_meta(meta: dict):
+    """
+    Разворачивает meta (чекпоинт или dict) в рабочие структуры (счётчики и множества).
+    """
+    return {
+        "events_by_day": defaultdict(int, meta.get("events_by_day", {})),
+        "leads_by_day": defaultdict(int, meta.get("leads_by_day", {})),
+        "by_platform_events": defaultdict(int, meta.get("by_platform_events", {})),
+        "by_theme_events": defaultdict(int, meta.get("by_theme_events", {})),
+        "by_lead_type_events": defaultdict(int, meta.get("by_lead_type_events", {})),
+        "by_creative_events": defaultdict(int, meta.get("by_creative_events", {})),
+        "by_platform_users": defaultdict(set, _as_set_dict(meta.get("by_platform_users"))),
+        "by_theme_users": defaultdict(set, _as_set_dict(meta.get("by_theme_users"))),
+        "by_lead_type_users": defaultdict(set, _as_set_dict(meta.get("by_lead_type_users"))),
+        "by_creative_users": defaultdict(set, _as_set_dict(meta.get("by_creative_users"))),
+        "creative_users_full_key": defaultdict(set, _as_set_dict(meta.get("creative_users_full_key"))),
+        "leads_by_theme_users": defaultdict(set, _as_set_dict(meta.get("leads_by_theme_users"))),
+        "all_users": set(meta.get("all_users", [])),
+        "users_with_lead": set(meta.get("users_with_lead", [])),
+        "unsubs_by_day": defaultdict(int, meta.get("unsubs_by_day", {})),
+        "users_unsubscribed": set(meta.get("users_unsubscribed", [])),
+    }
 
-    total_events = processed_before
 
-    # --- Обрабатываем только новые события ---
+def _prev_total_events(meta, processed: int) -> int:
+    """
+    Число учтённых событий (без битых строк) из meta. В чекпоинтах до
+    появления total_events его нет — тогда, как раньше, processed_events.
+    """
+    total = meta.get("total_events")
+    if total is None:
+        return processed
+    return max(int(total), 0)
+
+
+def _apply_events(state: dict, events) -> int:
+    """
+    Учитывает события (записи EventStream / EventRecord) в рабочих
+    структурах. events может быть любым итератором — события не
+    накапливаются. Возвращает число учтённых событий.
+    """
+    events_by_day = state["events_by_day"]
+    leads_by_day = state["leads_by_day"]
+    by_platform_events = state["by_platform_events"]
+    by_theme_events = state["by_theme_events"]
+    by_lead_type_events = state["by_lead_type_events"]
+    by_creative_events = state["by_creative_events"]
+    by_platform_users = state["by_platform_users"]
+    by_theme_users = state["by_theme_users"]
+    by_lead_type_users = state["by_lead_type_users"]
+    by_creative_users = state["by_creative_users"]
+    creative_users_full_key = state["creative_users_full_key"]
+    leads_by_theme_users = state["leads_by_theme_users"]
+    all_users = state["all_users"]
+    users_with_lead = state["users_with_lead"]
+    unsubs_by_day = state["unsubs_by_day"]
+    users_unsubscribed = state["users_unsubscribed"]
+
+    count = 0
     for ev in events:
-        total_events += 1
-        user_id = ev["user_id"]
-        event = ev["event"]
-        platform = ev["platform"] or ""
-        theme = ev["theme"] or ""
-        lead_type = ev["lead_type"] or ""
-        creative = ev["creative"] or ""
-        ts = ev["timestamp"]
+        count += 1
+        user_id = ev.user_id
+        event = ev.event
+        platform = ev.platform or ""
+        theme = ev.theme or ""
+        lead_type = ev.lead_type or ""
+        creative = ev.creative or ""
+        ts = ev.timestamp
 
         all_users.add(user_id)
 
@@ -101,6 +163,8 @@ def build_stats():
             events_by_day[day] += 1
             if event == "lead_sent":
                 leads_by_day[day] += 1
+            elif event == "unsubscribed":
+                unsubs_by_day[day] += 1
 
         # Структура по платформам
         if platform:
@@ -131,6 +195,20 @@ def build_stats():
                 key_full = f"{theme}_{lead_type}_{creative}"
                 creative_users_full_key[key_full].add(user_id)
 
+        # Отписки после выдачи лид-магнита (churn_check.py)
+        elif event == "unsubscribed":
+            users_unsubscribed.add(user_id)
+
+    return count
+
+
+def _render_stats(state: dict, total_events: int, processed_rows: int, users: dict):
+    """
+    Собирает итоговый stats.json (сводка для дашборда) и meta для
+    инкрементального пересчёта (уходит в чекпоинт, см. _write_stats) из
+    рабочих структур. meta ссылается на множества состояния — если оно
+    меняется параллельно, сначала снять копию через _snapshot_meta().
+    """
     def convert_counts(events_dict, users_dict):
         out = []
         for k in sorted(events_dict.keys()):
@@ -143,18 +221,23 @@ def build_stats():
             )
         return out
 
-    stats = {
+    creative_users_full_key = state["creative_users_full_key"]
+    leads_by_theme_users = state["leads_by_theme_users"]
+
+    return {
         "summary": {
             "total_events": total_events,
-            "total_users": len(all_users),
-            "users_with_lead": len(users_with_lead),
+            "total_users": len(state["all_users"]),
+            "users_with_lead": len(state["users_with_lead"]),
+            "users_unsubscribed": len(state["users_unsubscribed"]),
         },
-        "events_by_day": dict(events_by_day),
-        "leads_by_day": dict(leads_by_day),
-        "by_platform": convert_counts(by_platform_events, by_platform_users),
-        "by_theme": convert_counts(by_theme_events, by_theme_users),
-        "by_lead_type": convert_counts(by_lead_type_events, by_lead_type_users),
-        "by_creative": convert_counts(by_creative_events, by_creative_users),
+        "events_by_day": dict(state["events_by_day"]),
+        "leads_by_day": dict(state["leads_by_day"]),
+        "unsubs_by_day": dict(state["unsubs_by_day"]),
+        "by_platform": convert_counts(state["by_platform_events"], state["by_platform_users"]),
+        "by_theme": convert_counts(state["by_theme_events"], state["by_theme_users"]),
+        "by_lead_type": convert_counts(state["by_lead_type_events"], state["by_lead_type_users"]),
+        "by_creative": convert_counts(state["by_creative_events"], state["by_creative_users"]),
         "best_creatives": [
             {
                 "key": k,
@@ -171,40 +254,181 @@ def build_stats():
         },
         "users_raw": users,
         "meta": {
-            "processed_events": total_rows,
-            "events_by_day": dict(events_by_day),
-            "leads_by_day": dict(leads_by_day),
-            "by_platform_events": dict(by_platform_events),
-            "by_theme_events": dict(by_theme_events),
-            "by_lead_type_events": dict(by_lead_type_events),
-            "by_creative_events": dict(by_creative_events),
-            "by_platform_users": {k: list(v) for k, v in by_platform_users.items()},
-            "by_theme_users": {k: list(v) for k, v in by_theme_users.items()},
-            "by_lead_type_users": {k: list(v) for k, v in by_lead_type_users.items()},
-            "by_creative_users": {k: list(v) for k, v in by_creative_users.items()},
-            "creative_users_full_key": {
-                k: list(v) for k, v in creative_users_full_key.items()
-            },
-            "leads_by_theme_users": {
-                k: list(v) for k, v in leads_by_theme_users.items()
-            },
-            "all_users": list(all_users),
-            "users_with_lead": list(users_with_lead),
+            "processed_events": processed_rows,
+            "total_events": total_events,
+            "events_by_day": dict(state["events_by_day"]),
+            "leads_by_day": dict(state["leads_by_day"]),
+            "by_platform_events": dict(state["by_platform_events"]),
+            "by_theme_events": dict(state["by_theme_events"]),
+            "by_lead_type_events": dict(state["by_lead_type_events"]),
+            "by_creative_events": dict(state["by_creative_events"]),
+            "by_platform_users": dict(state["by_platform_users"]),
+            "by_theme_users": dict(state["by_theme_users"]),
+            "by_lead_type_users": dict(state["by_lead_type_users"]),
+            "by_creative_users": dict(state["by_creative_users"]),
+            "creative_users_full_key": dict(creative_users_full_key),
+            "leads_by_theme_users": dict(leads_by_theme_users),
+            "all_users": state["all_users"],
+            "users_with_lead": state["users_with_lead"],
+            "unsubs_by_day": dict(state["unsubs_by_day"]),
+            "users_unsubscribed": state["users_unsubscribed"],
         },
     }
 
-    if not os.path.exists(STATS_DIR):
+
+def _snapshot_meta(meta: dict) -> dict:
+    """Копия meta, не связанная с множествами рабочего состояния."""
+    out = {}
+    for name, value in meta.items():
+        if isinstance(value, set):
+            value = set(value)
+        elif isinstance(value, dict):
+            value = {k: set(v) if isinstance(v, set) else v for k, v in value.items()}
+        out[name] = value
+    return out
+
+
+def _write_stats(stats: dict):
+    """
+    Атомарно записывает stats.json: сначала во временный файл рядом,
+    затем os.replace. Читатели (дашборд, stats_server.py) никогда не видят
+    наполовину записанный файл, даже если бот и cron пишут одновременно.
+
+    meta пишется не в stats.json, а в бинарный чекпоинт stats/meta.ckpt —
+    до stats.json, чтобы сводка никогда не опережала чекпоинт.
+    """
+    meta = stats.get("meta")
+    stats = {k: v for k, v in stats.items() if k != "meta"}
+
+    stats_dir = current_profile().stats_dir
+    if not os.path.exists(stats_dir):
         try:
-            os.makedirs(STATS_DIR, exist_ok=True)
+            os.makedirs(stats_dir, exist_ok=True)
         except Exception:
             pass
 
+    tmp_path = None
     try:
-        with open(STATS_FILE, "w", encoding="utf-8") as f:
+        if meta is not None:
+            write_checkpoint(checkpoint_file(), meta)
+        fd, tmp_path = tempfile.mkstemp(prefix=".stats-", suffix=".tmp", dir=stats_dir)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
             json.dump(stats, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, stats_file())
+        tmp_path = None
     except Exception:
         pass
+    finally:
+        if tmp_path:
+            try:
+                os.remove(tmp_path)
+            except Exception:
+                pass
+
+
+def build_stats():
+    with stats_lock():
+        _build_stats_locked()
+
+
+def _build_stats_locked():
+    """build_stats() без блокировки — для вызова под уже взятой stats_lock()."""
+    prev_meta = _load_prev_meta()
+    processed_before = max(int(prev_meta.get("processed_events", 0) or 0), 0)
+
+    # --- Базовые структуры, подхватываем прошлые значения ---
+    state = _state_from_meta(prev_meta)
+    total_events = _prev_total_events(prev_meta, processed_before)
+
+    # --- Обрабатываем только новые события, по одному, не держа их в памяти ---
+    stream = EventStream(skip_rows=processed_before, fields=STATS_FIELDS)
+    total_events += _apply_events(state, stream)
+
+    # Если файл урезан/пересоздан — начинаем с нуля. Новых событий в этом
+    # случае не применялось (все строки ушли в skip).
+    if stream.corrupted or processed_before > stream.total_rows:
+        state = _state_from_meta(DEFAULT_META)
+        stream = EventStream(fields=STATS_FIELDS)
+        total_events = _apply_events(state, stream)
+
+    users = read_users()
+    _write_stats(_render_stats(state, total_events, stream.total_rows, users))
+
+
+def _discount_events(state: dict, events):
+    """
+    Обратное к _apply_events для счётчиков: вычитает события из счётчиков
+    по дням и измерениям (обнулившиеся ключи убираются, как будто этих
+    событий не было). Множества пользователей не трогает.
+    """
+    for ev in events:
+        counters = []
+        try:
+            day = datetime.fromisoformat(ev.timestamp).date().isoformat()
+        except Exception:
+            day = None
+        if day:
+            counters.append((state["events_by_day"], day))
+            if ev.event == "lead_sent":
+                counters.append((state["leads_by_day"], day))
+            elif ev.event == "unsubscribed":
+                counters.append((state["unsubs_by_day"], day))
+        for name, key in (
+            ("by_platform_events", ev.platform),
+            ("by_theme_events", ev.theme),
+            ("by_lead_type_events", ev.lead_type),
+            ("by_creative_events", ev.creative),
+        ):
+            if key:
+                counters.append((state[name], key))
+
+        for counter, key in counters:
+            if counter.get(key, 0) > 1:
+                counter[key] -= 1
+            else:
+                counter.pop(key, None)
+
+
+def forget_user(user_id: str, removed_rows: int, removed_events=()):
+    """
+    Убирает пользователя из всех множеств meta (уникальные пользователи по
+    платформам, темам, лидам и т.д.) и учитывает удаление его строк из
+    events.csv, которые уже были учтены: processed_events сдвигается на
+    removed_rows, а события removed_events (EventRecord, без битых строк)
+    вычитаются из счётчиков.
+
+    Вызывать под stats_lock() (и под storage.events_lock(), пока
+    переписывается events.csv).
+    """
+    user_id = str(user_id)
+    meta = _load_prev_meta()
+    processed_before = int(meta.get("processed_events", 0) or 0)
+    if processed_before <= 0:
+        return
+    processed = max(processed_before - removed_rows, 0)
+    # Как и build_stats(), считаем только целые события — битые строки
+    # в removed_events не попадают
+    total_events = max(_prev_total_events(meta, processed_before) - len(removed_events), 0)
+
+    state = _state_from_meta(meta)
+    _discount_events(state, removed_events)
+    for value in state.values():
+        if isinstance(value, set):
+            value.discard(user_id)
+        elif isinstance(value, dict):
+            for item in value.values():
+                if isinstance(item, set):
+                    item.discard(user_id)
+
+    _write_stats(_render_stats(state, total_events, processed, read_users()))
+
+
+def build_all_stats():
+    """Пересчитывает статистику для всех ботов из bots.json."""
+    for profile in load_profiles():
+        with use_profile(profile):
+            build_stats()
 
 
 if __name__ == "__main__":
-    build_stats()
+    build_all_stats()
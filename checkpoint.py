@@ -0,0 +1,254 @@
+# checkpoint.py
+# Бинарный чекпоинт инкрементальной статистики (meta для build_stats.py)
+
+import os
+import sys
+import mmap
+import zlib
+import struct
+import tempfile
+from array import array
+
+
+# Формат файла (все числа little-endian):
+#
+#   заголовок   magic (8 байт), версия (u16), резерв (u16), число секций (u32)
+#   таблица     на каждую секцию: тип (u8), имя (31 байт, utf-8 с нулями),
+#               смещение (u64), длина (u64), crc32 данных (u32)
+#   данные      секции подряд
+#
+# Типы секций:
+#   KIND_INT     целое i64 (processed_events, total_events)
+#   KIND_COUNTS  {ключ: i64} — строки ключей + массив значений
+#   KIND_USERS   множество user_id — число (u32) и id через "\n" (в user_id
+#                events.csv перевода строки быть не может)
+#   KIND_GROUPS  {ключ: множество user_id} — ключи + множества подряд
+#
+# Множества пользователей — основной объём, поэтому они пишутся одним
+# join и читаются одним split, без разбора каждого элемента.
+#
+# Несовместимые изменения формата — только с новой VERSION: файл другой
+# версии читатель не принимает, и build_stats.py пересчитывает всё заново.
+
+MAGIC = b"LMSTATS\0"
+VERSION = 1
+
+_HEADER = struct.Struct("<8sHHI")
+_ENTRY = struct.Struct("<B31sQQI")
+_U32 = struct.Struct("<I")
+_U64 = struct.Struct("<Q")
+_I64 = struct.Struct("<q")
+
+KIND_INT = 1
+KIND_COUNTS = 2
+KIND_USERS = 3
+KIND_GROUPS = 4
+
+_SWAP = sys.byteorder != "little"
+
+
+class CheckpointError(Exception):
+    """Чекпоинт не читается: обрезан, повреждён или другой версии."""
+
+
+# --- Кодирование ---
+
+def _array_bytes(arr: array) -> bytes:
+    if _SWAP:
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def _array_from(typecode: str, buf, pos: int, count: int):
+    arr = array(typecode)
+    end = pos + arr.itemsize * count
+    if end > len(buf):
+        raise CheckpointError("секция обрезана")
+    arr.frombytes(buf[pos:end])
+    if _SWAP:
+        arr.byteswap()
+    return arr, end
+
+
+def _pack_strings(items) -> bytes:
+    encoded = [s.encode("utf-8") for s in items]
+    lengths = array("I", map(len, encoded))
+    return _U32.pack(len(encoded)) + _array_bytes(lengths) + b"".join(encoded)
+
+
+def _unpack_strings(buf, pos: int):
+    (count,) = _U32.unpack_from(buf, pos)
+    lengths, pos = _array_from("I", buf, pos + _U32.size, count)
+    out = []
+    for length in lengths:
+        out.append(bytes(buf[pos:pos + length]).decode("utf-8"))
+        pos += length
+    return out, pos
+
+
+def _pack_users(users) -> bytes:
+    if not users:
+        return _U32.pack(0) + _U64.pack(0)
+    blob = "\n".join(users).encode("utf-8")
+    return _U32.pack(len(users)) + _U64.pack(len(blob)) + blob
+
+
+def _unpack_users(buf, pos: int):
+    (count,) = _U32.unpack_from(buf, pos)
+    (length,) = _U64.unpack_from(buf, pos + _U32.size)
+    pos += _U32.size + _U64.size
+    if pos + length > len(buf):
+        raise CheckpointError("секция обрезана")
+    if not count:
+        return set(), pos
+    users = set(bytes(buf[pos:pos + length]).decode("utf-8").split("\n"))
+    if len(users) != count:
+        raise CheckpointError("число пользователей не сходится")
+    return users, pos + length
+
+
+def _is_users(value) -> bool:
+    return isinstance(value, (set, frozenset, list, tuple))
+
+
+def _is_groups(value) -> bool:
+    return isinstance(value, dict) and bool(value) and _is_users(next(iter(value.values())))
+
+
+def _encode(value):
+    """(тип, байты) секции для значения meta."""
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, int):
+        return KIND_INT, _I64.pack(value)
+    if _is_users(value):
+        return KIND_USERS, _pack_users(value)
+    if _is_groups(value):
+        keys = list(value.keys())
+        parts = [_pack_strings(keys)]
+        for key in keys:
+            parts.append(_pack_users(value[key]))
+        return KIND_GROUPS, b"".join(parts)
+    if isinstance(value, dict):
+        keys = list(value.keys())
+        values = array("q", (int(value[k]) for k in keys))
+        return KIND_COUNTS, _pack_strings(keys) + _array_bytes(values)
+    raise TypeError(f"Тип {type(value).__name__} нельзя сохранить в чекпоинт")
+
+
+def _decode(kind: int, buf):
+    if kind == KIND_INT:
+        return _I64.unpack_from(buf, 0)[0]
+    if kind == KIND_COUNTS:
+        keys, pos = _unpack_strings(buf, 0)
+        values, _ = _array_from("q", buf, pos, len(keys))
+        return dict(zip(keys, values))
+    if kind == KIND_USERS:
+        return _unpack_users(buf, 0)[0]
+    if kind == KIND_GROUPS:
+        keys, pos = _unpack_strings(buf, 0)
+        out = {}
+        for key in keys:
+            out[key], pos = _unpack_users(buf, pos)
+        return out
+    raise CheckpointError(f"неизвестный тип секции: {kind}")
+
+
+# --- Запись и чтение ---
+
+def write_checkpoint(path: str, sections: dict):
+    """
+    Атомарно записывает чекпоинт: {имя секции: значение} (целое, счётчики,
+    множество пользователей или словарь множеств).
+    """
+    encoded = []
+    for name, value in sections.items():
+        raw_name = name.encode("utf-8")
+        if len(raw_name) > 31:
+            raise ValueError(f"Слишком длинное имя секции: {name}")
+        kind, data = _encode(value)
+        encoded.append((kind, raw_name, data))
+
+    offset = _HEADER.size + _ENTRY.size * len(encoded)
+    entries = []
+    for kind, raw_name, data in encoded:
+        entries.append(_ENTRY.pack(kind, raw_name, offset, len(data), zlib.crc32(data)))
+        offset += len(data)
+
+    fd, tmp_path = tempfile.mkstemp(prefix=".ckpt-", suffix=".tmp", dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(_HEADER.pack(MAGIC, VERSION, 0, len(encoded)))
+            f.write(b"".join(entries))
+            for _, _, data in encoded:
+                f.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class Checkpoint:
+    """
+    Чекпоинт, открытый на чтение через mmap.
+
+    При открытии проверяются magic, версия, таблица секций и crc32 всех
+    секций (это быстро — байты не разбираются). Сама секция разбирается при
+    первом обращении через get(), так что, например, processed_events
+    читается без разбора множеств пользователей.
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            try:
+                self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise CheckpointError("пустой файл")
+
+        buf = self._buf
+        if len(buf) < _HEADER.size:
+            raise CheckpointError("файл обрезан")
+        magic, version, _, count = _HEADER.unpack_from(buf, 0)
+        if magic != MAGIC:
+            raise CheckpointError("это не чекпоинт статистики")
+        if version != VERSION:
+            raise CheckpointError(f"версия {version}, ожидается {VERSION}")
+
+        self._sections = {}
+        self._values = {}
+        pos = _HEADER.size
+        for _ in range(count):
+            if pos + _ENTRY.size > len(buf):
+                raise CheckpointError("таблица секций обрезана")
+            kind, raw_name, offset, length, crc = _ENTRY.unpack_from(buf, pos)
+            pos += _ENTRY.size
+            if offset + length > len(buf):
+                raise CheckpointError("секция за концом файла")
+            if zlib.crc32(memoryview(buf)[offset:offset + length]) != crc:
+                raise CheckpointError("не сходится crc32 секции")
+            name = raw_name.rstrip(b"\0").decode("utf-8")
+            self._sections[name] = (kind, offset, length)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._sections
+
+    def names(self):
+        return list(self._sections)
+
+    def get(self, name: str, default=None):
+        if name in self._values:
+            return self._values[name]
+        section = self._sections.get(name)
+        if section is None:
+            return default
+        kind, offset, length = section
+        try:
+            value = _decode(kind, memoryview(self._buf)[offset:offset + length])
+        except (struct.error, UnicodeDecodeError, IndexError) as e:
+            raise CheckpointError(f"секция {name}: {e}")
+        self._values[name] = value
+        return value
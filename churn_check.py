@@ -0,0 +1,191 @@
+# churn_check.py
+# Фоновая перепроверка подписки у пользователей, уже получивших лид-магнит
+
+import heapq
+import time
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timedelta
+
+from telegram.error import BadRequest, TelegramError
+
+from config import (
+    CHURN_RATE_PER_SEC,
+    CHURN_CONCURRENCY,
+    CHURN_RUN_BUDGET_SEC,
+    CHURN_RECHECK_HOURS,
+    current_profile,
+    use_profile,
+)
+from storage import load_users, apply_subscription_checks, log_event
+from tg_client import RateLimiter, TelegramClient, TelegramUnavailable
+
+# Сколько результатов копим перед записью в users.json
+SAVE_BATCH = 200
+
+# Столько BadRequest подряд (без единого ответа со статусом) — ошибка канала
+# (бот потерял права, чат не найден), проход останавливаем
+MAX_BAD_REQUESTS = 5
+
+
+def _checked_at(data: dict):
+    """Когда последний раз проверяли подписку (None — никогда)."""
+    try:
+        return datetime.fromisoformat(data.get("_sub_cached_at") or "")
+    except ValueError:
+        return None
+
+
+def select_due_users(users: dict, limit: int, recheck_hours: float = CHURN_RECHECK_HOURS):
+    """
+    До limit пользователей с lead_sent=True, которых пора перепроверить:
+    сначала никогда не проверенные, затем — с самым старым _sub_cached_at.
+    Недавно проверенные (свежее recheck_hours) пропускаем.
+    """
+    if limit <= 0:
+        return []
+    border = datetime.now() - timedelta(hours=recheck_hours)
+    due = []
+    for user_id, data in users.items():
+        if not data.get("lead_sent"):
+            continue
+        checked_at = _checked_at(data)
+        if checked_at is None:
+            due.append((datetime.min, user_id))
+        elif checked_at <= border:
+            due.append((checked_at, user_id))
+    return [user_id for _, user_id in heapq.nsmallest(limit, due)]
+
+
+def _record_unsubscribed(user_ids, users: dict):
+    for user_id in user_ids:
+        data = users.get(user_id, {})
+        log_event(
+            user_id,
+            "unsubscribed",
+            platform=data.get("platform", ""),
+            theme=data.get("theme", ""),
+            lead_type=data.get("lead_type", ""),
+            creative=data.get("creative", ""),
+        )
+
+
+def run_churn_check(
+    tg: TelegramClient,
+    stop_event=None,
+    budget_sec: float = CHURN_RUN_BUDGET_SEC,
+    rate: float = CHURN_RATE_PER_SEC,
+    concurrency: int = CHURN_CONCURRENCY,
+):
+    """
+    Один проход перепроверки для текущего бота.
+
+    Пайплайн: очередь «самых давно проверенных» → не больше concurrency
+    запросов одновременно в отдельном маленьком пуле (пул обработчиков
+    апдейтов не занимаем) → token bucket на rate запросов/с → пачки
+    результатов в users.json и события unsubscribed в events.csv.
+
+    Отписавшимся считаем только явный статус left/kicked. BadRequest по
+    пользователю — пропуск без записи; MAX_BAD_REQUESTS таких подряд —
+    проблема с каналом, проход останавливается.
+
+    Проход останавливается по бюджету времени, по stop_event, при ошибке
+    канала или если get_chat_member недоступен (circuit breaker) — в
+    следующий запуск продолжим с тех же пользователей. Возвращает
+    (проверено, отписалось).
+    """
+    profile = current_profile()
+    deadline = time.monotonic() + budget_sec
+    users = load_users()
+    due = select_due_users(users, limit=int(rate * budget_sec) + concurrency)
+    if not due:
+        return 0, 0
+
+    limiter = RateLimiter(rate)
+
+    def check(user_id):
+        if not limiter.acquire(deadline):
+            return user_id, None
+        try:
+            return user_id, tg.membership(profile.channel_id, int(user_id))
+        except BadRequest:
+            # Не «не подписан» — BadRequest подряд считает цикл ниже.
+            # TelegramUnavailable тоже уходит наверх и останавливает проход.
+            raise
+        except TelegramError:
+            # Ответ API без статуса — пропускаем, проверим в другой раз
+            return user_id, None
+
+    checked = 0
+    unsubscribed = 0
+    results = {}
+    queue = iter(due)
+    pending = set()
+    api_down = False
+    bad_requests = 0
+
+    def flush():
+        nonlocal unsubscribed
+        if not results:
+            return
+        newly = apply_subscription_checks(results)
+        results.clear()
+        _record_unsubscribed(newly, users)
+        unsubscribed += len(newly)
+
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1), thread_name_prefix="churn") as pool:
+        while True:
+            stopping = api_down or bad_requests >= MAX_BAD_REQUESTS or time.monotonic() >= deadline or (stop_event is not None and stop_event.is_set())
+            while not stopping and len(pending) < concurrency:
+                user_id = next(queue, None)
+                if user_id is None:
+                    break
+                pending.add(pool.submit(check, user_id))
+            if not pending:
+                break
+
+            done, pending = wait(pending, timeout=1.0, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    user_id, is_member = future.result()
+                except TelegramUnavailable:
+                    api_down = True
+                    continue
+                except BadRequest:
+                    bad_requests += 1
+                    continue
+                if is_member is None:
+                    continue
+                bad_requests = 0
+                results[user_id] = is_member
+                checked += 1
+
+            if len(results) >= SAVE_BATCH:
+                flush()
+
+    flush()
+    if bad_requests >= MAX_BAD_REQUESTS:
+        print(f"[{datetime.now().isoformat(timespec='seconds')}] "
+              f"{profile.name}: перепроверка остановлена — get_chat_member отвечает BadRequest "
+              f"(права бота в канале?)")
+    return checked, unsubscribed
+
+
+def start_churn_thread(profile, tg: TelegramClient, stop_event):
+    """
+    Запускает проход перепроверки в фоне (в контексте профиля бота).
+    """
+    def _run():
+        with use_profile(profile):
+            try:
+                checked, unsubscribed = run_churn_check(tg, stop_event=stop_event)
+                if checked:
+                    print(f"[{datetime.now().isoformat(timespec='seconds')}] "
+                          f"{profile.name}: перепроверено {checked}, отписались {unsubscribed}")
+            except Exception:
+                traceback.print_exc()
+
+    thread = threading.Thread(target=_run, name=f"churn-{profile.name}", daemon=True)
+    thread.start()
+    return thread
@@ -2,6 +2,9 @@
 # Конфигурация Telegram-бота "Антиблокировка"
 
 import os
+import json
+import contextvars
+from contextlib import contextmanager
 from dotenv import load_dotenv
 
 # Базовая папка проекта (где лежит этот файл)
@@ -23,6 +26,11 @@ FREE_URL = os.getenv("FREE_URL", "").strip()
 BASE_URL = os.getenv("BASE_URL", "").strip()
 PRO_URL = os.getenv("PRO_URL", "").strip()
 
+# Telegram user_id администраторов через запятую — им доступна команда /stats
+ADMIN_IDS = frozenset(
+    int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x.lstrip("-").isdigit()
+)
+
 # --- Пути для данных и логов ---
 
 # Папка с данными (users.json и т.п.)
@@ -37,6 +45,97 @@ STATS_DIR = os.path.join(BASE_DIR, "stats")
 # Папка с файлами лид-магнитов
 LEADS_DIR = os.path.join(BASE_DIR, "assets", "leads")
 
+# --- Несколько ботов в одном процессе ---
+
+# Описание ботов (bots.json в корне проекта). Если файла нет — работает один
+# бот по настройкам из .env и папкам data/, logs/, stats/ выше.
+BOTS_FILE = os.path.join(BASE_DIR, "bots.json")
+
+# Общий пул потоков-обработчиков на все боты процесса
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "8") or 8)
+
+# Общий пул HTTP-соединений к Telegram на все боты процесса
+BOT_HTTP_POOL_SIZE = int(os.getenv("BOT_HTTP_POOL_SIZE", "8") or 8)
+
+# --- Клиент Telegram API (tg_client.py) ---
+
+# Адрес Bot API (пусто — https://api.telegram.org). Для проверок можно
+# направить бота на локальный фейковый сервер, например http://127.0.0.1:8081
+TG_API_URL = os.getenv("TG_API_URL", "").strip().rstrip("/")
+
+# Таймауты соединения и чтения по умолчанию, секунды
+TG_CONNECT_TIMEOUT = float(os.getenv("TG_CONNECT_TIMEOUT", "5") or 5)
+TG_READ_TIMEOUT = float(os.getenv("TG_READ_TIMEOUT", "10") or 10)
+
+# Бюджеты на отдельные методы: "get_chat_member=3,send_document=30"
+TG_METHOD_TIMEOUTS = os.getenv("TG_METHOD_TIMEOUTS", "").strip()
+
+# Повторы при сетевых ошибках и базовая пауза между ними (с джиттером)
+TG_RETRIES = int(os.getenv("TG_RETRIES", "2") or 2)
+TG_RETRY_BACKOFF_SEC = float(os.getenv("TG_RETRY_BACKOFF_SEC", "0.5") or 0.5)
+
+# Circuit breaker: после скольких ошибок подряд перестаём ходить в API
+# и на сколько секунд
+TG_BREAKER_THRESHOLD = int(os.getenv("TG_BREAKER_THRESHOLD", "5") or 5)
+TG_BREAKER_COOLDOWN_SEC = float(os.getenv("TG_BREAKER_COOLDOWN_SEC", "30") or 30)
+
+# --- Перепроверка подписки после выдачи лид-магнита (churn_check.py) ---
+
+# Включена ли фоновая перепроверка
+CHURN_ENABLED = os.getenv("CHURN_ENABLED", "1").strip() not in ("0", "false", "no")
+
+# Сколько запросов get_chat_member в секунду тратим на перепроверку
+# (на бота; лимит Telegram ~30 запросов/с, остальное — живым пользователям)
+CHURN_RATE_PER_SEC = float(os.getenv("CHURN_RATE_PER_SEC", "10") or 10)
+
+# Сколько проверок идёт параллельно (отдельно от пула обработчиков)
+CHURN_CONCURRENCY = int(os.getenv("CHURN_CONCURRENCY", "2") or 2)
+
+# Сколько секунд из ~50-секундного запуска бота отдаём перепроверке
+CHURN_RUN_BUDGET_SEC = float(os.getenv("CHURN_RUN_BUDGET_SEC", "40") or 40)
+
+# Не перепроверять пользователя чаще, чем раз в столько часов
+CHURN_RECHECK_HOURS = float(os.getenv("CHURN_RECHECK_HOURS", "24") or 24)
+
+# Лимит памяти под кэш файлов лид-магнитов (общий на все боты), МБ
+ASSET_CACHE_MAX_MB = int(os.getenv("ASSET_CACHE_MAX_MB", "64") or 64)
+
+# --- HTTP-сервис статистики (stats_server.py) ---
+
+# Адрес и порт, на которых слушает сервис
+STATS_API_HOST = os.getenv("STATS_API_HOST", "127.0.0.1").strip()
+STATS_API_PORT = int(os.getenv("STATS_API_PORT", "8087") or 8087)
+
+# Разрешённый Origin для дашборда (CORS), "*" — любой
+STATS_API_CORS_ORIGIN = os.getenv("STATS_API_CORS_ORIGIN", "*").strip()
+
+# --- Живая статистика в процессе бота (live_stats.py) ---
+
+# Включена ли потоковая агрегация событий внутри бота
+LIVE_STATS_ENABLED = os.getenv("LIVE_STATS_ENABLED", "1").strip() not in ("0", "false", "no")
+
+# Как часто (в секундах) сбрасывать снимок в stats/stats.json
+LIVE_STATS_FLUSH_SEC = float(os.getenv("LIVE_STATS_FLUSH_SEC", "5") or 5)
+
+# --- Индекс событий по пользователям (user_index.py) ---
+
+# Дописывать logs/events.idx вместе с events.csv прямо в процессе бота
+USER_INDEX_ENABLED = os.getenv("USER_INDEX_ENABLED", "1").strip() not in ("0", "false", "no")
+
+# --- Бортовой самописец апдейтов (flight_recorder.py) ---
+
+# Писать ли трассы апдейтов (шаги обработчика, вызовы Telegram, хранилище)
+FLIGHT_RECORDER_ENABLED = os.getenv("FLIGHT_RECORDER_ENABLED", "1").strip() not in ("0", "false", "no")
+
+# Сколько последних трасс держать в памяти
+FLIGHT_RECORDER_SIZE = int(os.getenv("FLIGHT_RECORDER_SIZE", "200") or 200)
+
+# Апдейт дольше этого (мс) сохраняется в logs/slow_updates со срезами стека
+SLOW_UPDATE_MS = float(os.getenv("SLOW_UPDATE_MS", "2000") or 2000)
+
+# Сколько следующих апдейтов профилировать cProfile по SIGUSR1 / команде /profile
+PROFILE_NEXT_UPDATES = int(os.getenv("PROFILE_NEXT_UPDATES", "20") or 20)
+
 # Создаём папки при необходимости
 for path in (DATA_DIR, LOGS_DIR, STATS_DIR, LEADS_DIR):
     if not os.path.exists(path):
@@ -94,6 +193,8 @@ def get_lead_file_path(theme: str, lead_type: str, creative: str) -> str:
     Ключ формируется строго как:
         "{theme}_{lead_type}_{creative}"  (например, "TH1_CL_01")
 
+    Берёт LEAD_FILES и папку лид-магнитов из текущего профиля бота.
+
     Если:
         - ключа нет в LEAD_FILES, или
         - файла нет на диске,
@@ -106,14 +207,169 @@ def get_lead_file_path(theme: str, lead_type: str, creative: str) -> str:
     if not theme or not lead_type or not creative:
         return ""
 
+    profile = current_profile()
     key = f"{theme}_{lead_type}_{creative}"
-    filename = LEAD_FILES.get(key)
+    filename = profile.lead_files.get(key)
 
     if not filename:
         return ""
 
-    full_path = os.path.join(LEADS_DIR, filename)
+    full_path = os.path.join(profile.leads_dir, filename)
     if not os.path.isfile(full_path):
         return ""
 
     return full_path
+
+
+# --- Профили ботов ---
+
+class BotProfile:
+    """
+    Настройки одного бота: токен, канал, ссылки на курсы, лид-магниты и
+    собственные папки data / logs / stats.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        token: str,
+        channel_id: str,
+        free_url: str = "",
+        base_url: str = "",
+        pro_url: str = "",
+        data_dir: str = DATA_DIR,
+        logs_dir: str = LOGS_DIR,
+        stats_dir: str = STATS_DIR,
+        leads_dir: str = LEADS_DIR,
+        lead_files: dict = None,
+        admin_ids=ADMIN_IDS,
+    ):
+        self.name = name
+        self.token = token
+        self.channel_id = channel_id
+        self.free_url = free_url
+        self.base_url = base_url
+        self.pro_url = pro_url
+        self.data_dir = data_dir
+        self.logs_dir = logs_dir
+        self.stats_dir = stats_dir
+        self.leads_dir = leads_dir
+        self.lead_files = lead_files if lead_files is not None else {}
+        self.admin_ids = frozenset(admin_ids)
+
+    def __repr__(self):
+        return f"BotProfile({self.name!r})"
+
+
+DEFAULT_PROFILE = BotProfile(
+    name="default",
+    token=BOT_TOKEN,
+    channel_id=CHANNEL_ID,
+    free_url=FREE_URL,
+    base_url=BASE_URL,
+    pro_url=PRO_URL,
+    lead_files=LEAD_FILES,
+)
+
+_CURRENT_PROFILE = contextvars.ContextVar("bot_profile", default=DEFAULT_PROFILE)
+
+
+def _profile_from_dict(item: dict) -> BotProfile:
+    """
+    Собирает профиль из записи bots.json:
+
+        {
+          "name": "antiblock",
+          "token_env": "ANTIBLOCK_BOT_TOKEN",   # или "token": "123:AA..."
+          "channel_id": "@Borodulin_expert",
+          "free_url": "...", "base_url": "...", "pro_url": "...",
+          "data_root": "bots/antiblock",         # по умолчанию bots/<name>
+          "leads_dir": "assets/leads",           # по умолчанию общая папка
+          "lead_files": {"TH1_CL_01": "checklist_24h.pdf"},
+          "admin_ids": [243676537]               # по умолчанию ADMIN_IDS из .env
+        }
+
+    Относительные пути считаются от BASE_DIR. "data_root": "." — старая
+    раскладка (data/, logs/, stats/ в корне проекта).
+    """
+    name = str(item.get("name") or "").strip()
+    if not name:
+        raise ValueError("В bots.json у бота не задано имя (name)")
+
+    token = str(item.get("token") or "").strip()
+    if not token and item.get("token_env"):
+        token = os.getenv(str(item["token_env"]), "").strip()
+
+    data_root = os.path.join(BASE_DIR, item.get("data_root") or os.path.join("bots", name))
+    leads_dir = os.path.join(BASE_DIR, item.get("leads_dir") or LEADS_DIR)
+
+    return BotProfile(
+        name=name,
+        token=token,
+        channel_id=str(item.get("channel_id") or "").strip(),
+        free_url=str(item.get("free_url") or "").strip(),
+        base_url=str(item.get("base_url") or "").strip(),
+        pro_url=str(item.get("pro_url") or "").strip(),
+        data_dir=os.path.join(data_root, "data"),
+        logs_dir=os.path.join(data_root, "logs"),
+        stats_dir=os.path.join(data_root, "stats"),
+        leads_dir=leads_dir,
+        lead_files=dict(item.get("lead_files") or {}),
+        admin_ids=[int(x) for x in item["admin_ids"]] if "admin_ids" in item else ADMIN_IDS,
+    )
+
+
+def load_profiles():
+    """
+    Возвращает список профилей из bots.json или [DEFAULT_PROFILE], если
+    файла нет.
+    """
+    if not os.path.isfile(BOTS_FILE):
+        return [DEFAULT_PROFILE]
+
+    with open(BOTS_FILE, "r", encoding="utf-8") as f:
+        items = json.load(f)
+
+    profiles = [_profile_from_dict(item) for item in items]
+    names = [p.name for p in profiles]
+    if len(set(names)) != len(names):
+        raise ValueError("В bots.json повторяются имена ботов")
+
+    for profile in profiles:
+        for path in (profile.data_dir, profile.logs_dir, profile.stats_dir):
+            try:
+                os.makedirs(path, exist_ok=True)
+            except Exception:
+                pass
+    return profiles
+
+
+def get_profile(name: str = "") -> BotProfile:
+    """
+    Профиль по имени; пустое имя — первый профиль из load_profiles().
+    """
+    profiles = load_profiles()
+    if not name:
+        return profiles[0]
+    for profile in profiles:
+        if profile.name == name:
+            return profile
+    raise KeyError(f"Бот {name!r} не найден")
+
+
+def current_profile() -> BotProfile:
+    """Профиль бота, в контексте которого выполняется код."""
+    return _CURRENT_PROFILE.get()
+
+
+@contextmanager
+def use_profile(profile: BotProfile):
+    """
+    Выполняет блок в контексте профиля: storage, utils, build_stats и
+    get_lead_file_path работают с его папками и настройками.
+    """
+    token = _CURRENT_PROFILE.set(profile)
+    try:
+        yield profile
+    finally:
+        _CURRENT_PROFILE.reset(token)
@@ -25,6 +25,8 @@ if [ ! -x "$VENV_PY" ]; then
     exit 1
 fi
 
+# exec: python заменяет этот sh и получает тот же pid, поэтому в pid-файле
+# pid самого процесса (kill -USR1 по нему уходит процессу, а не оболочке).
+# Устаревший pid-файл после остановки отсекает проверка kill -0 выше.
 echo $$ > "$PID_FILE"
-"$VENV_PY" bot_polling.py >> "$LOG_FILE" 2>&1
-rm -f "$PID_FILE"
+exec "$VENV_PY" bot_polling.py >> "$LOG_FILE" 2>&1
@@ -0,0 +1,32 @@
+#!/bin/sh
+
+SCRIPT_DIR="/home/c/ck60067/borodulin.expert/public_html/my_script/bot-telegram-lid-magnita"
+VENV_PY="/home/c/ck60067/venv/bin/python"
+LOG_FILE="/home/c/ck60067/cron_Bot_StatsApi_Antiblokirovka.log"
+PID_FILE="$SCRIPT_DIR/tmp/stats_server.pid"
+
+export PYTHONIOENCODING="utf-8"
+
+cd "$SCRIPT_DIR" || exit 1
+
+mkdir -p tmp
+
+# Сервис долгоживущий: если уже запущен — выходим (по pid-файлу)
+if [ -f "$PID_FILE" ]; then
+    old_pid="$(cat "$PID_FILE" 2>/dev/null)"
+    if [ -n "$old_pid" ] && kill -0 "$old_pid" 2>/dev/null; then
+        exit 0
+    fi
+fi
+
+if [ ! -x "$VENV_PY" ]; then
+    echo "$(date -Iseconds) python not found at $VENV_PY" >> "$LOG_FILE"
+    exit 1
+fi
+
+# exec: python заменяет этот sh и получает тот же pid, поэтому проверка
+# kill -0 выше смотрит на сам stats_server.py. Устаревший pid-файл после
+# остановки она же и отсекает. Обработчика SIGUSR1 у stats_server.py нет.
+echo $$ > "$PID_FILE"
+echo "$(date -Iseconds) stats_server start" >> "$LOG_FILE"
+exec "$VENV_PY" stats_server.py >> "$LOG_FILE" 2>&1
@@ -0,0 +1,337 @@
+# flight_recorder.py
+# Бортовой самописец апдейтов: трассы последних апдейтов, дампы медленных
+# и профилирование по запросу
+
+import os
+import io
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+import contextvars
+import traceback
+from collections import Counter, deque
+from contextlib import nullcontext
+from datetime import datetime
+from functools import wraps
+
+from config import (
+    FLIGHT_RECORDER_ENABLED,
+    FLIGHT_RECORDER_SIZE,
+    SLOW_UPDATE_MS,
+    current_profile,
+)
+
+
+SLOW_UPDATES_DIR = "slow_updates"
+
+# Срезы стека снимаем с апдейтов, которые идут дольше SAMPLE_AFTER_MS,
+# раз в SAMPLE_INTERVAL_SEC
+SAMPLE_INTERVAL_SEC = 0.02
+SAMPLE_AFTER_MS = 200
+MAX_STACK_DEPTH = 40
+PROFILE_TOP = 40
+
+# Трасса апдейта, который обрабатывает текущий поток (None — трассы нет)
+_CURRENT_TRACE = contextvars.ContextVar("update_trace", default=None)
+_NOOP = nullcontext()
+
+
+class _Span:
+    __slots__ = ("trace", "name", "detail", "start")
+
+    def __init__(self, trace, name, detail):
+        self.trace = trace
+        self.name = name
+        self.detail = detail
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.trace.spans.append(
+            (self.name, self.detail, self.start, time.perf_counter(), exc_type.__name__ if exc_type else "")
+        )
+        return False
+
+
+def span(name: str, detail: str = None):
+    """
+    Отрезок трассы текущего апдейта: with span("tg", "send_document"): ...
+    Вне апдейта (cron, фоновые потоки) — пустой контекст, почти без затрат.
+    """
+    trace = _CURRENT_TRACE.get()
+    if trace is None:
+        return _NOOP
+    return _Span(trace, name, detail)
+
+
+def traced(name: str):
+    """Декоратор: вызов функции — отрезок трассы с именем name."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            trace = _CURRENT_TRACE.get()
+            if trace is None:
+                return func(*args, **kwargs)
+            with _Span(trace, name, None):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class UpdateTrace:
+    """Трасса одного апдейта: отрезки, срезы стека, профиль cProfile."""
+
+    def __init__(self, recorder, handler: str, user_id=None):
+        self.recorder = recorder
+        self.handler = handler
+        self.user_id = user_id
+        self.profile = current_profile()
+        self.spans = []
+        self.samples = Counter()
+        self.profiler = None
+        self.started_at = None
+        self.start = None
+        self.thread_id = None
+        self.duration_ms = 0.0
+        self.error = ""
+        self._token = None
+
+    def __enter__(self):
+        self.started_at = datetime.now()
+        self.start = time.perf_counter()
+        self.thread_id = threading.get_ident()
+        self._token = _CURRENT_TRACE.set(self)
+        begun = False
+        try:
+            self.recorder._begin(self)
+            begun = True
+            self._start_profiler()
+        except BaseException:
+            # Апдейт не должен остаться «активным» в самописце и в контексте
+            # потока пула, если трассу начать не удалось
+            if begun:
+                self.recorder._abort(self)
+            _CURRENT_TRACE.reset(self._token)
+            raise
+        return self
+
+    def _start_profiler(self):
+        # С Python 3.12 cProfile один на процесс: профилируем не больше одного
+        # апдейта одновременно, остальные — только с отрезками и срезами стека
+        if not self.recorder._take_profile_slot(self):
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Профилировщик уже занят чем-то ещё (отладчик, другой профилировщик)
+            self.recorder._release_profile_slot(self)
+            return
+        self.profiler = profiler
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.profiler is not None:
+            try:
+                self.profiler.disable()
+            finally:
+                self.recorder._release_profile_slot(self)
+        self.duration_ms = (time.perf_counter() - self.start) * 1000
+        self.error = exc_type.__name__ if exc_type else ""
+        _CURRENT_TRACE.reset(self._token)
+        try:
+            self.recorder._finish(self)
+        except Exception:
+            traceback.print_exc()
+        return False
+
+    def to_dict(self, details: bool = True) -> dict:
+        out = {
+            "bot": self.profile.name,
+            "handler": self.handler,
+            "user_id": self.user_id,
+            "started_at": self.started_at.isoformat(timespec="milliseconds"),
+            "duration_ms": round(self.duration_ms, 1),
+            "error": self.error,
+            "spans": [
+                {
+                    "name": f"{name}.{detail}" if detail else name,
+                    "start_ms": round((start - self.start) * 1000, 1),
+                    "duration_ms": round((end - start) * 1000, 1),
+                    "error": error,
+                }
+                for name, detail, start, end, error in list(self.spans)
+            ],
+        }
+        if details:
+            # Срезы дописывает поток-сэмплер — берём копию под его блокировкой
+            with self.recorder._lock:
+                samples = Counter(self.samples)
+            out["stack_samples"] = [
+                {"count": count, "stack": list(stack)}
+                for stack, count in samples.most_common(20)
+            ]
+            if self.profiler is not None:
+                buf = io.StringIO()
+                pstats.Stats(self.profiler, stream=buf).sort_stats("cumulative").print_stats(PROFILE_TOP)
+                out["profile"] = buf.getvalue()
+        return out
+
+
+class FlightRecorder:
+    """
+    Держит последние size трасс апдейтов (кольцевой буфер) и сохраняет в
+    logs/slow_updates/ JSON-файлом:
+        - апдейт дольше slow_ms — с отрезками и срезами стека (их снимает
+          фоновый поток, пока апдейт идёт дольше SAMPLE_AFTER_MS);
+        - апдейты, отмеченные profile_next(n), — ещё и с профилем cProfile.
+
+    Без включённого профилирования на апдейт приходятся только отметки
+    времени отрезков; вне апдейтов span/traced почти ничего не стоят, а
+    поток срезов спит на Event, пока нет ни одного активного апдейта.
+    cProfile одновременно включён не больше чем у одного апдейта.
+    """
+
+    def __init__(self, size: int = FLIGHT_RECORDER_SIZE, slow_ms: float = SLOW_UPDATE_MS,
+                 enabled: bool = FLIGHT_RECORDER_ENABLED):
+        self.enabled = enabled
+        self.slow_ms = slow_ms
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=max(size, 1))
+        self._active = {}
+        self._profile_left = 0
+        self._profiling = None  # трасса, у которой сейчас включён cProfile
+        self._sampler = None
+        self._wake = threading.Event()
+
+    # --- Жизненный цикл трассы ---
+
+    def trace(self, handler: str, user_id=None):
+        """Контекст обработки одного апдейта (пустой, если самописец выключен)."""
+        if not self.enabled:
+            return _NOOP
+        return UpdateTrace(self, handler, user_id)
+
+    def _begin(self, trace: UpdateTrace):
+        with self._lock:
+            self._active[trace.thread_id] = trace
+            self._wake.set()
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample_loop, name="flight-sampler", daemon=True)
+                self._sampler.start()
+
+    def _abort(self, trace: UpdateTrace):
+        """Откатывает _begin для трассы, которую не удалось начать."""
+        with self._lock:
+            if self._active.get(trace.thread_id) is trace:
+                del self._active[trace.thread_id]
+            if self._profiling is trace:
+                self._profiling = None
+
+    def _finish(self, trace: UpdateTrace):
+        with self._lock:
+            self._active.pop(trace.thread_id, None)
+            self._recent.append(trace)
+        if trace.profiler is not None or trace.duration_ms >= self.slow_ms:
+            self._dump(trace.profile, f"{trace.handler}_{trace.user_id or ''}", trace.to_dict())
+
+    # --- Профилирование по запросу ---
+
+    def profile_next(self, n: int):
+        """Профилировать cProfile следующие n апдейтов (сигнал / команда)."""
+        with self._lock:
+            self._profile_left = max(int(n), 0)
+
+    def _take_profile_slot(self, trace: UpdateTrace) -> bool:
+        """
+        Разрешает трассе включить cProfile. Пока профилируется другой апдейт,
+        слот не расходуется — его возьмёт следующий апдейт.
+        """
+        if not self._profile_left:
+            return False
+        with self._lock:
+            if self._profile_left <= 0 or self._profiling is not None:
+                return False
+            self._profile_left -= 1
+            self._profiling = trace
+            return True
+
+    def _release_profile_slot(self, trace: UpdateTrace):
+        with self._lock:
+            if self._profiling is trace:
+                self._profiling = None
+
+    # --- Срезы стека ---
+
+    def _sample_loop(self):
+        while True:
+            # Пока активных апдейтов нет, поток спит и не просыпается по таймеру
+            self._wake.wait()
+            time.sleep(SAMPLE_INTERVAL_SEC)
+            now = time.perf_counter()
+            with self._lock:
+                if not self._active:
+                    self._wake.clear()
+                    continue
+                due = [t for t in self._active.values() if (now - t.start) * 1000 >= SAMPLE_AFTER_MS]
+            if not due:
+                continue
+            frames = sys._current_frames()
+            stacks = []
+            for trace in due:
+                frame = frames.get(trace.thread_id)
+                if frame is not None:
+                    stacks.append((trace, _stack_key(frame)))
+            del frames
+            with self._lock:
+                for trace, stack in stacks:
+                    trace.samples[stack] += 1
+
+    # --- Дампы ---
+
+    def recent(self) -> list:
+        with self._lock:
+            return list(self._recent)
+
+    def dump_recent(self):
+        """Сохраняет кольцевой буфер (по файлу на бота) и возвращает пути."""
+        by_profile = {}
+        for trace in self.recent():
+            by_profile.setdefault(trace.profile, []).append(trace.to_dict(details=False))
+        paths = []
+        for profile, traces in by_profile.items():
+            path = self._dump(profile, "recent", {"traces": traces})
+            if path:
+                paths.append(path)
+        return paths
+
+    def _dump(self, profile, label: str, payload: dict):
+        folder = os.path.join(profile.logs_dir, SLOW_UPDATES_DIR)
+        name = "{}_{}.json".format(datetime.now().strftime("%Y%m%d-%H%M%S-%f"), label)
+        try:
+            os.makedirs(folder, exist_ok=True)
+            path = os.path.join(folder, name)
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(payload, f, ensure_ascii=False, indent=2)
+            return path
+        except Exception:
+            return None
+
+
+def _stack_key(frame) -> tuple:
+    """Стек потока от внешнего вызова к текущему: ("файл:строка функция", ...)."""
+    out = []
+    while frame is not None and len(out) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        out.append(f"{os.path.basename(code.co_filename)}:{frame.f_lineno} {code.co_name}")
+        frame = frame.f_back
+    out.reverse()
+    return tuple(out)
+
+
+# Один самописец на процесс (все боты)
+RECORDER = FlightRecorder()
@@ -0,0 +1,209 @@
+# live_stats.py
+# Потоковая агрегация событий внутри процесса бота
+
+import os
+import heapq
+import threading
+import traceback
+from datetime import date, timedelta
+
+from config import LIVE_STATS_FLUSH_SEC, current_profile, use_profile
+from build_stats import (
+    stats_lock,
+    _build_stats_locked,
+    _load_prev_meta,
+    _prev_total_events,
+    _state_from_meta,
+    _apply_events,
+    _render_stats,
+    _snapshot_meta,
+    _write_stats,
+)
+from storage import add_event_listener, remove_event_listener, events_file, events_lock
+from utils import read_users
+
+
+def _file_identity(path: str):
+    """(inode, устройство) файла: меняется, когда файл подменяют целиком."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_dev
+
+
+class LiveStats:
+    """
+    Держит в памяти те же счётчики и множества пользователей, что и
+    build_stats.py, и обновляет их на каждое событие из storage.log_event.
+
+    Раз в flush_sec секунд (если были новые события) атомарно пишет снимок
+    в stats/stats.json. Снимок всегда согласован: meta.processed_events равен
+    числу строк events.csv, учтённых в счётчиках, поэтому cron-запуск
+    build_stats.py после бота просто ничего не находит (или досчитывает
+    хвост, если бот упал до сброса).
+
+    Если events.csv переписали целиком (удаление данных пользователя через
+    user_index.py), состояние в памяти устарело: снимок не пишется, а
+    состояние заново собирается с диска.
+
+    Работает с профилем бота, в контексте которого создан; события других
+    ботов процесса пропускает.
+    """
+
+    def __init__(self, flush_sec: float = LIVE_STATS_FLUSH_SEC):
+        self.profile = current_profile()
+        self.flush_sec = max(float(flush_sec), 0.5)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._state = None
+        self._total_events = 0
+        self._processed_rows = 0
+        self._dirty = False
+        self._events_identity = None
+        # Номер версии состояния: растёт с каждым событием, по нему
+        # кэшируется сводка для /stats
+        self._version = 0
+        self._report = None
+
+    def _reload(self):
+        """
+        Досчитывает всё, что есть в events.csv, и берёт результат как
+        состояние. Порядок блокировок: события → состояние → stats.json
+        (тот же, что у log_event и удаления пользователя).
+        """
+        with use_profile(self.profile):
+            with events_lock():
+                with self._lock:
+                    with stats_lock():
+                        _build_stats_locked()
+                        meta = _load_prev_meta()
+                    processed = max(int(meta.get("processed_events", 0) or 0), 0)
+                    self._state = _state_from_meta(meta)
+                    self._processed_rows = processed
+                    self._total_events = _prev_total_events(meta, processed)
+                    self._dirty = False
+                    self._events_identity = _file_identity(events_file())
+                    self._version += 1
+
+    def start(self):
+        self._reload()
+        add_event_listener(self.on_event)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="live-stats", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        remove_event_listener(self.on_event)
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_sec + 5)
+            self._thread = None
+        self.flush()
+
+    def on_event(self, row, location=None):
+        if current_profile() is not self.profile:
+            return
+        with self._lock:
+            if self._state is None:
+                return
+            _apply_events(self._state, (row,))
+            self._processed_rows += 1
+            self._total_events += 1
+            self._dirty = True
+            self._version += 1
+
+    def report(self, top_n: int = 10):
+        """
+        Короткая сводка для команды /stats прямо из состояния в памяти (без
+        чтения events.csv и stats.json):
+            totals     — события, пользователи, с лидом, отписались;
+            days       — события/лиды/отписки за сегодня и вчера;
+            top        — [(THx_TT_NN, уникальных пользователей)], top_n лучших;
+            platforms  — [(платформа, пользователей, с лидом)] по убыванию.
+        Пока новых событий нет и не сменились сутки, возвращается готовая
+        сводка.
+        """
+        with self._lock:
+            if self._state is None:
+                return None
+            today = date.today()
+            cache_key = (self._version, today)
+            cached = self._report
+            if cached is not None and cached[0] == cache_key and cached[1] >= top_n:
+                report = dict(cached[2])
+                report["top"] = report["top"][:top_n]
+                return report
+
+            state = self._state
+            days = {}
+            for day in (today, today - timedelta(days=1)):
+                key = day.isoformat()
+                days[key] = {
+                    "events": state["events_by_day"].get(key, 0),
+                    "leads": state["leads_by_day"].get(key, 0),
+                    "unsubs": state["unsubs_by_day"].get(key, 0),
+                }
+
+            users_with_lead = state["users_with_lead"]
+            platforms = sorted(
+                (
+                    (platform, len(users), len(users & users_with_lead))
+                    for platform, users in state["by_platform_users"].items()
+                ),
+                key=lambda item: item[1],
+                reverse=True,
+            )
+
+            report = {
+                "totals": {
+                    "events": self._total_events,
+                    "users": len(state["all_users"]),
+                    "with_lead": len(users_with_lead),
+                    "unsubscribed": len(state["users_unsubscribed"]),
+                },
+                "days": days,
+                "top": [
+                    (key, len(users))
+                    for key, users in heapq.nlargest(
+                        top_n,
+                        state["creative_users_full_key"].items(),
+                        key=lambda item: len(item[1]),
+                    )
+                ],
+                "platforms": platforms,
+            }
+            self._report = (cache_key, top_n, report)
+            return dict(report)
+
+    def flush(self):
+        """Сбрасывает снимок на диск, если с прошлого раза были события."""
+        with use_profile(self.profile):
+            if _file_identity(events_file()) != self._events_identity:
+                self._reload()
+                return
+
+            with self._lock:
+                if self._state is None or not self._dirty:
+                    return
+                self._dirty = False
+                # Снимок meta отвязан от множеств состояния — после этого
+                # файлы можно писать уже без блокировки, не задерживая обработчики
+                stats = _render_stats(self._state, self._total_events, self._processed_rows, {})
+                stats["meta"] = _snapshot_meta(stats["meta"])
+
+            stats["users_raw"] = read_users()
+            with stats_lock():
+                # Пока рендерили, events.csv могли переписать — тогда снимок
+                # устарел, соберём состояние заново на следующем сбросе
+                if _file_identity(events_file()) != self._events_identity:
+                    return
+                _write_stats(stats)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_sec):
+            try:
+                self.flush()
+            except Exception:
+                traceback.print_exc()
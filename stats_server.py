@@ -0,0 +1,334 @@
+# stats_server.py
+# Read-only HTTP-сервис статистики поверх stats/stats.json (вывод build_stats.py)
+
+import os
+import json
+import hashlib
+import threading
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from config import STATS_API_HOST, STATS_API_PORT, STATS_API_CORS_ORIGIN
+from config import load_profiles, use_profile
+from build_stats import stats_file
+from utils import safe_load_json
+
+
+# Разделы stats.json, которые наружу не отдаём (служебные и персональные данные)
+PRIVATE_SECTIONS = ("meta", "users_raw")
+
+# Измерения, доступные через /api/dimension/<name>
+DIMENSIONS = {
+    "platform": "by_platform",
+    "theme": "by_theme",
+    "lead_type": "by_lead_type",
+    "creative": "by_creative",
+}
+
+DEFAULT_TOP_N = 10
+MAX_TOP_N = 500
+RESPONSE_CACHE_SIZE = 256
+
+
+class StatsStore:
+    """
+    Держит в памяти последнюю версию stats.json и кэш готовых ответов.
+
+    Файл перечитывается, только если изменились его mtime/размер
+    (build_stats.py перезаписывает его целиком), вместе с этим сбрасывается
+    кэш ответов.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._signature = None
+        self._stats = {}
+        self._mtime = 0.0
+        self._responses = {}
+
+    def _file_signature(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None, 0.0
+        return (st.st_mtime_ns, st.st_size), st.st_mtime
+
+    def snapshot(self):
+        """
+        Возвращает (stats, signature, mtime) с учётом свежести файла.
+        """
+        signature, mtime = self._file_signature()
+        with self._lock:
+            if signature != self._signature:
+                data = safe_load_json(self.path, {}) if signature else {}
+                if not isinstance(data, dict):
+                    data = {}
+                for section in PRIVATE_SECTIONS:
+                    data.pop(section, None)
+                self._stats = data
+                self._signature = signature
+                self._mtime = mtime
+                self._responses = {}
+            return self._stats, self._signature, self._mtime
+
+    def cached_response(self, key, signature, build):
+        """
+        Возвращает (body, etag) для ключа запроса. build(stats) вызывается,
+        только если ответа нет в кэше для текущей версии файла.
+        """
+        with self._lock:
+            if signature == self._signature and key in self._responses:
+                return self._responses[key]
+            stats = self._stats
+
+        payload = build(stats)
+        body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+
+        with self._lock:
+            if signature == self._signature:
+                if len(self._responses) >= RESPONSE_CACHE_SIZE:
+                    self._responses = {}
+                self._responses[key] = (body, etag)
+        return body, etag
+
+
+# --- Построение ответов ---
+
+def _parse_day(value: str):
+    value = (value or "").strip()
+    if not value:
+        return ""
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date().isoformat()
+    except ValueError:
+        raise ValueError(f"Некорректная дата: {value}")
+
+
+def _parse_keys(params: dict, name: str):
+    raw = ",".join(params.get(name, []))
+    return {k.strip() for k in raw.split(",") if k.strip()}
+
+
+def _filter_days(series: dict, day_from: str, day_to: str):
+    out = {}
+    for day, value in (series or {}).items():
+        if day_from and day < day_from:
+            continue
+        if day_to and day > day_to:
+            continue
+        out[day] = value
+    return dict(sorted(out.items()))
+
+
+def build_summary(stats: dict, params: dict):
+    return {
+        "summary": stats.get("summary", {}),
+        "leads_by_theme_users": stats.get("leads_by_theme_users", {}),
+    }
+
+
+def build_days(stats: dict, params: dict):
+    day_from = _parse_day((params.get("from") or [""])[0])
+    day_to = _parse_day((params.get("to") or [""])[0])
+    events_by_day = _filter_days(stats.get("events_by_day"), day_from, day_to)
+    leads_by_day = _filter_days(stats.get("leads_by_day"), day_from, day_to)
+    unsubs_by_day = _filter_days(stats.get("unsubs_by_day"), day_from, day_to)
+    return {
+        "from": day_from,
+        "to": day_to,
+        "events_by_day": events_by_day,
+        "leads_by_day": leads_by_day,
+        "unsubs_by_day": unsubs_by_day,
+        "total_events": sum(events_by_day.values()),
+        "total_leads": sum(leads_by_day.values()),
+        "total_unsubs": sum(unsubs_by_day.values()),
+    }
+
+
+def build_dimension(name: str):
+    section = DIMENSIONS[name]
+
+    def _build(stats: dict, params: dict):
+        keys = _parse_keys(params, "keys")
+        rows = stats.get(section) or []
+        if keys:
+            rows = [row for row in rows if row.get("key") in keys]
+        return {"dimension": name, "items": rows}
+
+    return _build
+
+
+def build_top_creatives(stats: dict, params: dict):
+    try:
+        n = int((params.get("n") or [DEFAULT_TOP_N])[0])
+    except ValueError:
+        raise ValueError("Параметр n должен быть числом")
+    n = max(1, min(n, MAX_TOP_N))
+
+    # Фильтр по частям ключа THx_TT_NN
+    themes = _parse_keys(params, "theme")
+    lead_types = _parse_keys(params, "lead_type")
+    creatives = _parse_keys(params, "creative")
+
+    out = []
+    for row in stats.get("best_creatives") or []:
+        parts = (row.get("key") or "").split("_")
+        if len(parts) != 3:
+            continue
+        theme, lead_type, creative = parts
+        if themes and theme not in themes:
+            continue
+        if lead_types and lead_type not in lead_types:
+            continue
+        if creatives and creative not in creatives:
+            continue
+        out.append(row)
+        if len(out) >= n:
+            break
+    return {"items": out}
+
+
+def _route(path: str):
+    """
+    Возвращает функцию построения ответа для пути или None.
+    """
+    if path == "/api/summary":
+        return build_summary
+    if path == "/api/days":
+        return build_days
+    if path == "/api/top_creatives":
+        return build_top_creatives
+    if path.startswith("/api/dimension/"):
+        name = path[len("/api/dimension/"):]
+        if name in DIMENSIONS:
+            return build_dimension(name)
+    return None
+
+
+# --- HTTP ---
+
+class StatsRequestHandler(BaseHTTPRequestHandler):
+    server_version = "LeadStats/1.0"
+    stores = None  # {имя бота: StatsStore}, задаётся в make_server()
+    default_bot = ""
+
+    def log_message(self, fmt, *args):
+        # Не засоряем cron-лог каждым запросом дашборда
+        pass
+
+    def _send(self, status: int, body: bytes = b"", headers: dict = None):
+        self.send_response(status)
+        self.send_header("Access-Control-Allow-Origin", STATS_API_CORS_ORIGIN or "*")
+        self.send_header("Access-Control-Expose-Headers", "ETag, Last-Modified")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body and self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _send_error(self, status: int, message: str):
+        body = json.dumps({"error": message}, ensure_ascii=False).encode("utf-8")
+        self._send(status, body)
+
+    def _not_modified(self, etag: str, mtime: float):
+        inm = self.headers.get("If-None-Match")
+        if inm is not None:
+            tags = [t.strip() for t in inm.split(",")]
+            return etag in tags or "*" in tags
+        ims = self.headers.get("If-Modified-Since")
+        if ims:
+            try:
+                since = parsedate_to_datetime(ims)
+            except (TypeError, ValueError):
+                return False
+            return int(mtime) <= int(since.timestamp())
+        return False
+
+    def do_OPTIONS(self):
+        self._send(204, headers={
+            "Access-Control-Allow-Methods": "GET, HEAD, OPTIONS",
+            "Access-Control-Allow-Headers": "If-None-Match, If-Modified-Since",
+        })
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        build = _route(parts.path.rstrip("/") or "/")
+        if build is None:
+            self._send_error(404, "Неизвестный путь")
+            return
+
+        params = parse_qs(parts.query)
+        bot = (params.pop("bot", None) or [self.default_bot])[0]
+        store = self.stores.get(bot)
+        if store is None:
+            self._send_error(404, f"Бот {bot} не найден")
+            return
+
+        _, signature, mtime = store.snapshot()
+        if signature is None:
+            self._send_error(503, "Статистика ещё не построена")
+            return
+
+        key = (parts.path, tuple(sorted((k, tuple(v)) for k, v in params.items())))
+        try:
+            body, etag = store.cached_response(
+                key, signature, lambda stats: build(stats, params)
+            )
+        except ValueError as e:
+            self._send_error(400, str(e))
+            return
+
+        headers = {
+            "ETag": etag,
+            "Last-Modified": format_datetime(
+                datetime.fromtimestamp(int(mtime), tz=timezone.utc), usegmt=True
+            ),
+            "Cache-Control": "no-cache",
+        }
+        if self._not_modified(etag, mtime):
+            self._send(304, headers=headers)
+            return
+        self._send(200, body, headers)
+
+    do_HEAD = do_GET
+
+
+def make_server(host: str = STATS_API_HOST, port: int = STATS_API_PORT):
+    """
+    Сервер на все боты из bots.json: бот выбирается параметром ?bot=<имя>,
+    без него — первый по списку.
+    """
+    stores = {}
+    profiles = load_profiles()
+    for profile in profiles:
+        with use_profile(profile):
+            stores[profile.name] = StatsStore(stats_file())
+
+    handler = type(
+        "BoundStatsRequestHandler",
+        (StatsRequestHandler,),
+        {"stores": stores, "default_bot": profiles[0].name},
+    )
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main():
+    server = make_server()
+    print(f"Stats API слушает http://{STATS_API_HOST}:{STATS_API_PORT}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
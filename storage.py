@@ -3,68 +3,183 @@
 
 import os
 import json
+import tempfile
+import threading
+import traceback
+from collections import namedtuple
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
-from config import DATA_DIR, LOGS_DIR
+try:
+    import fcntl
+except ImportError:  # не-Unix: межпроцессной блокировки нет
+    fcntl = None
+
+from config import current_profile
+from flight_recorder import traced
 
 
-USERS_FILE = os.path.join(DATA_DIR, "users.json")
-EVENTS_FILE = os.path.join(LOGS_DIR, "events.csv")
 SUB_CACHE_TTL_SEC = 1800  # 30 минут
 
+# Колонки events.csv по порядку
+EVENT_FIELDS = (
+    "timestamp",
+    "chat_id",
+    "user_id",
+    "event",
+    "platform",
+    "theme",
+    "lead_type",
+    "creative",
+    "extra",
+)
+EVENTS_HEADER = ";".join(EVENT_FIELDS) + "\n"
+
+# Одна строка events.csv (компактнее dict: без словаря на каждую строку)
+EventRecord = namedtuple("EventRecord", EVENT_FIELDS)
+
+# Где лежит строка события: файл-сегмент (имя в папке logs) и байты в нём
+EventLocation = namedtuple("EventLocation", ("segment", "offset", "length"))
+
+# users.json читается и переписывается целиком, поэтому изменения из разных
+# потоков (общий пул обработчиков) идут строго по очереди. Между процессами
+# (бот / user_index.py purge) — ещё и flock, см. users_lock().
+_USERS_LOCK = threading.RLock()
+_USERS_LOCK_DEPTH = threading.local()
+
+# Запись в events.csv и уведомление подписчиков идут под одной блокировкой,
+# чтобы порядок событий у подписчиков совпадал с порядком строк в файле.
+# Между процессами (бот / cron / ручные скрипты) — ещё и flock, см. events_lock().
+_EVENTS_LOCK = threading.Lock()
+_EVENT_LISTENERS = []
+
+
+def users_file() -> str:
+    """Путь к users.json текущего бота."""
+    return os.path.join(current_profile().data_dir, "users.json")
+
+
+def events_file() -> str:
+    """Путь к events.csv текущего бота."""
+    return os.path.join(current_profile().logs_dir, "events.csv")
+
+
+@contextmanager
+def file_lock(path: str):
+    """
+    Эксклюзивная межпроцессная блокировка (flock) на файл-замок path.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(path, "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+@contextmanager
+def events_lock():
+    """
+    Блокировка events.csv текущего бота: под ней дописываются события и
+    переписывается файл целиком (удаление данных пользователя).
+    """
+    with _EVENTS_LOCK:
+        with file_lock(os.path.join(current_profile().logs_dir, "events.lock")):
+            yield
+
+
+@contextmanager
+def users_lock():
+    """
+    Блокировка users.json текущего бота на всё «прочитать — изменить —
+    записать». Повторный вход из того же потока не берёт flock заново
+    (flock на новый дескриптор того же файла заблокировал бы сам себя).
+    """
+    with _USERS_LOCK:
+        depth = getattr(_USERS_LOCK_DEPTH, "value", 0)
+        _USERS_LOCK_DEPTH.value = depth + 1
+        try:
+            if depth:
+                yield
+            else:
+                _ensure_files()
+                with file_lock(os.path.join(current_profile().data_dir, "users.lock")):
+                    yield
+        finally:
+            _USERS_LOCK_DEPTH.value = depth
+
 
 def _ensure_files():
     """Создаём файлы при необходимости."""
-    if not os.path.exists(DATA_DIR):
+    profile = current_profile()
+    if not os.path.exists(profile.data_dir):
         try:
-            os.makedirs(DATA_DIR, exist_ok=True)
+            os.makedirs(profile.data_dir, exist_ok=True)
         except Exception:
             pass
 
-    if not os.path.exists(LOGS_DIR):
+    if not os.path.exists(profile.logs_dir):
         try:
-            os.makedirs(LOGS_DIR, exist_ok=True)
+            os.makedirs(profile.logs_dir, exist_ok=True)
         except Exception:
             pass
 
-    if not os.path.isfile(USERS_FILE):
+    if not os.path.isfile(users_file()):
         try:
-            with open(USERS_FILE, "w", encoding="utf-8") as f:
+            with open(users_file(), "w", encoding="utf-8") as f:
                 json.dump({}, f, ensure_ascii=False, indent=2)
         except Exception:
             pass
 
-    if not os.path.isfile(EVENTS_FILE):
+    if not os.path.isfile(events_file()):
         try:
-            with open(EVENTS_FILE, "w", encoding="utf-8") as f:
-                f.write(
-                    "timestamp;chat_id;user_id;event;"
-                    "platform;theme;lead_type;creative;extra\n"
-                )
+            with open(events_file(), "w", encoding="utf-8") as f:
+                f.write(EVENTS_HEADER)
         except Exception:
             pass
 
 
+@traced("storage.load_users")
 def load_users():
     """Загружает словарь пользователей из users.json."""
     _ensure_files()
     try:
-        with open(USERS_FILE, "r", encoding="utf-8") as f:
+        with open(users_file(), "r", encoding="utf-8") as f:
             return json.load(f)
     except Exception:
         return {}
 
 
+@traced("storage.save_users")
 def save_users(users: dict):
-    """Сохраняет словарь пользователей в users.json."""
+    """
+    Сохраняет словарь пользователей в users.json атомарно: во временный
+    файл рядом, затем os.replace. Читатели без блокировки (load_users из
+    обработчиков общего пула) видят либо старый файл, либо новый целиком,
+    но не обрезанный.
+    """
     _ensure_files()
+    tmp_path = None
     try:
-        with open(USERS_FILE, "w", encoding="utf-8") as f:
+        fd, tmp_path = tempfile.mkstemp(prefix=".users-", suffix=".tmp", dir=current_profile().data_dir)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
             json.dump(users, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, users_file())
+        tmp_path = None
     except Exception:
         pass
+    finally:
+        if tmp_path:
+            try:
+                os.remove(tmp_path)
+            except Exception:
+                pass
 
 
+@traced("storage.update_user")
 def update_user(
     user_id: int,
     chat_id: int = None,
@@ -85,45 +200,52 @@ def update_user(
         - creative (01, 02, ...)
         - lead_sent (bool) — выдавался ли лид-магнит хоть раз
     """
-    users = load_users()
-    key = str(user_id)
-    data = users.get(key, {})
-
-    if chat_id is not None:
-        data["chat_id"] = chat_id
-    if platform is not None:
-        data["platform"] = platform
-    if theme is not None:
-        data["theme"] = theme
-    if lead_type is not None:
-        data["lead_type"] = lead_type
-    if creative is not None:
-        data["creative"] = creative
-    if lead_sent is not None:
-        data["lead_sent"] = bool(lead_sent)
-
-    users[key] = data
-    save_users(users)
+    with users_lock():
+        users = load_users()
+        key = str(user_id)
+        data = users.get(key, {})
+
+        if chat_id is not None:
+            data["chat_id"] = chat_id
+        if platform is not None:
+            data["platform"] = platform
+        if theme is not None:
+            data["theme"] = theme
+        if lead_type is not None:
+            data["lead_type"] = lead_type
+        if creative is not None:
+            data["creative"] = creative
+        if lead_sent is not None:
+            data["lead_sent"] = bool(lead_sent)
 
+        users[key] = data
+        save_users(users)
 
+
+@traced("storage.cache_subscription_status")
 def cache_subscription_status(user_id: int, is_member: bool, ttl_seconds: int = SUB_CACHE_TTL_SEC):
     """
     Сохраняет статус подписки и время кэширования.
     """
-    users = load_users()
-    key = str(user_id)
-    data = users.get(key, {})
-    data["_sub_status"] = bool(is_member)
-    data["_sub_cached_at"] = datetime.now().isoformat()
-    data["_sub_ttl"] = int(ttl_seconds)
-    users[key] = data
-    save_users(users)
+    with users_lock():
+        users = load_users()
+        key = str(user_id)
+        data = users.get(key, {})
+        data["_sub_status"] = bool(is_member)
+        data["_sub_cached_at"] = datetime.now().isoformat()
+        data["_sub_ttl"] = int(ttl_seconds)
+        users[key] = data
+        save_users(users)
 
 
-def get_cached_subscription(user_id: int):
+@traced("storage.get_cached_subscription")
+def get_cached_subscription(user_id: int, allow_stale: bool = False):
     """
     Возвращает кэшированный статус подписки (True/False) или None, если нет
     валидного кэша.
+
+    allow_stale=True — вернуть последний известный статус даже с истёкшим
+    TTL (используется, когда Telegram API недоступен).
     """
     users = load_users()
     data = users.get(str(user_id), {})
@@ -132,6 +254,8 @@ def get_cached_subscription(user_id: int):
     ttl = int(data.get("_sub_ttl", SUB_CACHE_TTL_SEC) or SUB_CACHE_TTL_SEC)
     if status is None or cached_at is None:
         return None
+    if allow_stale:
+        return bool(status)
     try:
         ts = datetime.fromisoformat(cached_at)
     except Exception:
@@ -141,6 +265,51 @@ def get_cached_subscription(user_id: int):
     return bool(status)
 
 
+def remove_user(user_id: int):
+    """Удаляет запись пользователя из users.json. True — если она была."""
+    with users_lock():
+        users = load_users()
+        if users.pop(str(user_id), None) is None:
+            return False
+        save_users(users)
+        return True
+
+
+def apply_subscription_checks(results: dict, ttl_seconds: int = SUB_CACHE_TTL_SEC):
+    """
+    Записывает пачку результатов перепроверки подписки {user_id: is_member}
+    за одно чтение/запись users.json.
+
+    Пользователям, получившим лид-магнит и вышедшим из канала, ставит
+    отметку _unsubscribed_at (повторно не ставит, снимает при возврате в
+    канал). Пользователей, которых уже нет в users.json, пропускает.
+    Возвращает список user_id, отписавшихся впервые.
+    """
+    newly_unsubscribed = []
+    now = datetime.now().isoformat()
+    with users_lock():
+        users = load_users()
+        for user_id, is_member in results.items():
+            key = str(user_id)
+            data = users.get(key)
+            if data is None:
+                # Пользователя удалили, пока шёл проход (user_index.py purge) —
+                # не возвращаем его запись
+                continue
+            data["_sub_status"] = bool(is_member)
+            data["_sub_cached_at"] = now
+            data["_sub_ttl"] = int(ttl_seconds)
+            if is_member:
+                data.pop("_unsubscribed_at", None)
+            elif data.get("lead_sent") and not data.get("_unsubscribed_at"):
+                data["_unsubscribed_at"] = now
+                newly_unsubscribed.append(key)
+            users[key] = data
+        save_users(users)
+    return newly_unsubscribed
+
+
+@traced("storage.log_event")
 def log_event(
     user_id: int,
     event: str,
@@ -163,10 +332,46 @@ def log_event(
     line = (
         f"{ts};{chat_id};{user_id};{event};"
         f"{platform};{theme};{lead_type};{creative};{extra}\n"
-    )
+    ).encode("utf-8")
+
+    path = events_file()
+    with events_lock():
+        try:
+            with open(path, "ab") as f:
+                offset = f.tell()
+                f.write(line)
+        except Exception:
+            return
+
+        if not _EVENT_LISTENERS:
+            return
+
+        # Та же запись, что отдаёт utils.EventStream для строки файла
+        row = EventRecord(
+            ts, str(chat_id), str(user_id), event,
+            platform, theme, lead_type, creative, extra,
+        )
+        location = EventLocation(os.path.basename(path), offset, len(line))
+        for callback in list(_EVENT_LISTENERS):
+            try:
+                callback(row, location)
+            except Exception:
+                traceback.print_exc()
 
+
+def add_event_listener(callback):
+    """
+    Подписывает callback(row, location) на каждое успешно записанное событие.
+    row — EventRecord с полями строки events.csv, location — EventLocation
+    (где строка лежит в файле).
+    """
+    if callback not in _EVENT_LISTENERS:
+        _EVENT_LISTENERS.append(callback)
+
+
+def remove_event_listener(callback):
+    """Отписывает callback от событий."""
     try:
-        with open(EVENTS_FILE, "a", encoding="utf-8") as f:
-            f.write(line)
-    except Exception:
+        _EVENT_LISTENERS.remove(callback)
+    except ValueError:
         pass
@@ -0,0 +1,287 @@
+# tg_client.py
+# Устойчивый слой вызовов Telegram Bot API: пул соединений, таймауты по
+# методам, ограниченные повторы с джиттером и circuit breaker
+
+import time
+import random
+import threading
+
+from telegram import Bot
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+from telegram.utils.request import Request
+
+from flight_recorder import span
+from config import (
+    BOT_HTTP_POOL_SIZE,
+    TG_API_URL,
+    TG_CONNECT_TIMEOUT,
+    TG_READ_TIMEOUT,
+    TG_METHOD_TIMEOUTS,
+    TG_RETRIES,
+    TG_RETRY_BACKOFF_SEC,
+    TG_BREAKER_THRESHOLD,
+    TG_BREAKER_COOLDOWN_SEC,
+)
+
+
+# Бюджеты по умолчанию (секунды на одну попытку). Проверка подписки должна
+# отвечать быстро, загрузка файла — может идти долго.
+DEFAULT_METHOD_TIMEOUTS = {
+    "get_chat_member": 3.0,
+    "answer_callback_query": 3.0,
+    "edit_message_text": 5.0,
+    "send_message": 5.0,
+    "send_document": 30.0,
+}
+
+# Методы, которые безопасно повторять после таймаута: повтор не приведёт
+# к дублю сообщения у пользователя. Остальные повторяем только по RetryAfter
+# (Telegram гарантирует, что запрос не выполнен).
+IDEMPOTENT_METHODS = {"get_chat_member", "get_me", "answer_callback_query"}
+
+# Сколько максимум ждём по RetryAfter внутри одного вызова
+MAX_RETRY_AFTER_SEC = 5.0
+MAX_BACKOFF_SEC = 5.0
+
+MEMBER_STATUSES = ("member", "administrator", "creator")
+# Явный ответ «в канале не состоит»
+LEFT_STATUSES = ("left", "kicked")
+
+
+class TelegramUnavailable(Exception):
+    """API недоступен: circuit breaker открыт или исчерпаны повторы."""
+
+
+def _parse_method_timeouts(raw: str):
+    """
+    "get_chat_member=3,send_document=30" -> {"get_chat_member": 3.0, ...}
+    """
+    out = dict(DEFAULT_METHOD_TIMEOUTS)
+    for item in (raw or "").split(","):
+        if "=" not in item:
+            continue
+        name, value = item.split("=", 1)
+        try:
+            out[name.strip()] = float(value)
+        except ValueError:
+            pass
+    return out
+
+
+METHOD_TIMEOUTS = _parse_method_timeouts(TG_METHOD_TIMEOUTS)
+
+
+def make_request(pool_size: int = BOT_HTTP_POOL_SIZE) -> Request:
+    """
+    Общий пул keep-alive соединений к Bot API (urllib3 держит соединения
+    открытыми между запросами). Один на процесс, его делят все боты.
+    """
+    return Request(
+        con_pool_size=pool_size,
+        connect_timeout=TG_CONNECT_TIMEOUT,
+        read_timeout=TG_READ_TIMEOUT,
+    )
+
+
+def make_bot(token: str, request: Request) -> Bot:
+    """Bot поверх общего пула; TG_API_URL подменяет адрес Bot API."""
+    if TG_API_URL:
+        return Bot(
+            token,
+            request=request,
+            base_url=f"{TG_API_URL}/bot",
+            base_file_url=f"{TG_API_URL}/file/bot",
+        )
+    return Bot(token, request=request)
+
+
+class CircuitBreaker:
+    """
+    closed — запросы идут как обычно;
+    open — после threshold ошибок подряд запросы сразу отклоняются
+           на cooldown секунд (обработчик не висит на таймауте);
+    half-open — после паузы пропускаем один пробный запрос: успех
+           закрывает breaker, ошибка снова открывает.
+    """
+
+    def __init__(self, threshold: int = TG_BREAKER_THRESHOLD, cooldown: float = TG_BREAKER_COOLDOWN_SEC):
+        self.threshold = max(int(threshold), 1)
+        self.cooldown = float(cooldown)
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.cooldown:
+                return "half-open"
+            return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.cooldown:
+                return False
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._opened_at is not None or self._failures >= self.threshold:
+                self._opened_at = time.monotonic()
+
+
+class RateLimiter:
+    """
+    Token bucket: не больше rate запросов в секунду, всплеск до burst.
+    Используется фоновыми задачами, чтобы не выедать лимиты Telegram,
+    нужные живым пользователям.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = max(float(rate), 0.01)
+        self.burst = max(int(burst), 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, deadline: float = None) -> bool:
+        """
+        Ждёт свободный токен. False — если до deadline (time.monotonic())
+        токена не дождаться.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class TelegramClient:
+    """
+    Обёртка над Bot одного бота. Все вызовы API из обработчиков идут через
+    call(): таймаут по методу, повторы с джиттером и отдельный circuit
+    breaker на каждый метод (медленный get_chat_member не закрывает
+    отправку сообщений).
+    """
+
+    def __init__(self, bot: Bot, retries: int = TG_RETRIES, backoff: float = TG_RETRY_BACKOFF_SEC):
+        self.bot = bot
+        self.retries = max(int(retries), 0)
+        self.backoff = float(backoff)
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def breaker(self, method: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(method)
+            if breaker is None:
+                breaker = self._breakers[method] = CircuitBreaker()
+            return breaker
+
+    def _sleep_backoff(self, attempt: int):
+        delay = min(self.backoff * (2 ** attempt), MAX_BACKOFF_SEC)
+        time.sleep(delay * random.uniform(0.5, 1.5))
+
+    def call(self, method: str, func=None, *args, **kwargs):
+        """
+        Вызывает func(*args, timeout=<бюджет метода>, **kwargs); по умолчанию
+        func — одноимённый метод Bot. Для методов объектов апдейта
+        (query.edit_message_text и т.п.) передаём сам bound-метод.
+
+        BadRequest/Unauthorized пробрасываются как есть (API ответил);
+        сетевые ошибки после всех повторов и открытый breaker — как
+        TelegramUnavailable.
+        """
+        if func is None:
+            func = getattr(self.bot, method)
+        kwargs.setdefault("timeout", METHOD_TIMEOUTS.get(method, TG_READ_TIMEOUT))
+        # В трассе апдейта — один отрезок на вызов, вместе с повторами
+        with span("tg", method):
+            return self._call(method, func, args, kwargs)
+
+    def _call(self, method: str, func, args, kwargs):
+        breaker = self.breaker(method)
+        retryable = method in IDEMPOTENT_METHODS
+
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                raise TelegramUnavailable(f"{method}: circuit breaker открыт")
+            try:
+                result = func(*args, **kwargs)
+            except RetryAfter as e:
+                # Флуд-контроль — API жив, breaker не трогаем
+                breaker.record_success()
+                if attempt >= self.retries or e.retry_after > MAX_RETRY_AFTER_SEC:
+                    raise TelegramUnavailable(f"{method}: {e}") from e
+                time.sleep(e.retry_after)
+            except BadRequest:
+                breaker.record_success()
+                raise
+            except NetworkError as e:
+                breaker.record_failure()
+                if not retryable or attempt >= self.retries:
+                    raise TelegramUnavailable(f"{method}: {e}") from e
+                self._sleep_backoff(attempt)
+            except TelegramError:
+                # Unauthorized, ChatMigrated и т.п. — ответ API, не деградация
+                breaker.record_success()
+                raise
+            except Exception:
+                # Не ответ API (OSError, ошибка разбора и т.п.) — считаем
+                # сбоем; заодно снимается флаг пробного запроса half-open,
+                # иначе breaker метода остался бы открытым навсегда
+                breaker.record_failure()
+                raise
+            else:
+                breaker.record_success()
+                return result
+            attempt += 1
+
+    # --- Удобные обёртки ---
+
+    def membership(self, chat_id, user_id):
+        """
+        Строгий статус подписки: True — в канале, False — только явный
+        ответ left/kicked, None — статус не определить (restricted без
+        is_member и т.п.). BadRequest (бот потерял права, чат не найден,
+        список участников недоступен) пробрасывается: это ошибка канала,
+        а не «не подписан».
+        """
+        member = self.call("get_chat_member", None, chat_id, user_id)
+        if member.status in MEMBER_STATUSES:
+            return True
+        if member.status in LEFT_STATUSES:
+            return False
+        if member.status == "restricted":
+            return bool(getattr(member, "is_member", False))
+        return None
+
+    def send_document(self, **kwargs):
+        return self.call("send_document", None, **kwargs)
+
+    def send_message(self, **kwargs):
+        return self.call("send_message", None, **kwargs)
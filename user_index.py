@@ -0,0 +1,563 @@
+# user_index.py
+# Индекс user_id → строки events.csv: лента событий пользователя и удаление
+# его данных без полного перебора журнала
+
+import os
+import sys
+import heapq
+import argparse
+import tempfile
+import threading
+from bisect import bisect_left
+
+from config import current_profile, get_profile, use_profile
+from storage import (
+    EventLocation,
+    EventRecord,
+    EVENT_FIELDS,
+    add_event_listener,
+    events_file,
+    events_lock,
+    remove_user,
+)
+from build_stats import stats_lock, forget_user, _load_prev_meta
+
+
+INDEX_NAME = "events.idx"
+JOURNAL_NAME = "events.idx.log"
+COPY_CHUNK = 1024 * 1024
+
+# Журнал индекса больше этого — сливаем его в отсортированный индекс
+# (поиск читает журнал целиком, поэтому он должен оставаться маленьким)
+JOURNAL_MAX_BYTES = 1024 * 1024
+
+
+def index_file() -> str:
+    """Путь к индексу текущего бота (рядом с events.csv)."""
+    return os.path.join(current_profile().logs_dir, INDEX_NAME)
+
+
+def journal_file() -> str:
+    """Путь к журналу индекса (ещё не слитые записи)."""
+    return os.path.join(current_profile().logs_dir, JOURNAL_NAME)
+
+
+def _format_entry(segment: str, user_id: str, offset: int, length: int) -> str:
+    # Формат строки журнала: сегмент;user_id;смещение;длина
+    return f"{segment};{user_id};{offset};{length}\n"
+
+
+def _parse_entry(line: str):
+    parts = line.rstrip("\n").split(";")
+    if len(parts) != 4:
+        return None
+    try:
+        return parts[0], parts[1], int(parts[2]), int(parts[3])
+    except ValueError:
+        return None
+
+
+def _format_sorted(user_id: str, segment: str, offset: int, length: int) -> bytes:
+    # Формат строки индекса: user_id;сегмент;смещение;длина
+    return f"{user_id};{segment};{offset};{length}\n".encode("utf-8")
+
+
+def _parse_sorted(line: bytes):
+    """(user_id, сегмент, смещение, длина) — порядок сортировки индекса."""
+    parts = line.decode("utf-8", "replace").rstrip("\n").split(";")
+    if len(parts) != 4:
+        return None
+    try:
+        return parts[0], parts[1], int(parts[2]), int(parts[3])
+    except ValueError:
+        return None
+
+
+def _parse_line(line: bytes):
+    parts = line.decode("utf-8", "replace").rstrip("\n").split(";", len(EVENT_FIELDS) - 1)
+    if len(parts) != len(EVENT_FIELDS):
+        return None
+    return EventRecord(*parts)
+
+
+def _line_user_id(line: bytes) -> str:
+    parts = line.split(b";", 3)
+    if len(parts) < 4:
+        return ""
+    return parts[2].decode("utf-8", "replace").strip()
+
+
+def _write_atomic(path: str, lines, header: bytes = b""):
+    fd, tmp_path = tempfile.mkstemp(prefix=".idx-", suffix=".tmp", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(header)
+            f.writelines(lines)
+        os.replace(tmp_path, path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _header(last) -> bytes:
+    """
+    Первая строка индекса: последняя (по порядку в журнале событий) запись,
+    до которой он полон — по ней проверяется, что индекс сходится с events.csv.
+    """
+    if last is None:
+        return b"#\n"
+    return b"#" + _format_entry(*last).encode("utf-8")
+
+
+class UserEventIndex:
+    """
+    Индекс событий одного бота.
+
+    На диске два файла рядом с events.csv:
+        - logs/events.idx — строки «user_id;сегмент;смещение;длина»,
+          отсортированные по user_id (затем по сегменту и смещению), и
+          строка-заголовок с последней проиндексированной записью журнала.
+          Записи пользователя ищутся двоичным поиском по байтам файла —
+          O(log N) чтений, без разбора всего индекса;
+        - logs/events.idx.log — журнал: строки «сегмент;user_id;смещение;
+          длина» в порядке записи в events.csv. Дописывается вместе с каждой
+          строкой events.csv (слушатель storage.log_event); больше
+          JOURNAL_MAX_BYTES — сливается в events.idx при следующем
+          обращении.
+
+    Если индекс отстал, он догоняется чтением только хвоста events.csv после
+    последней проиндексированной строки. Лента пользователя — двоичный поиск,
+    чтение небольшого журнала и k чтений по смещениям (k — число его событий).
+    """
+
+    def __init__(self, profile=None):
+        self.profile = profile or current_profile()
+        self._lock = threading.Lock()
+
+    # --- Догоняем events.csv ---
+
+    def _last_entry(self):
+        """
+        Последняя проиндексированная запись (сегмент, user_id, смещение,
+        длина); None — индекс пуст; False — индекс не читается (старый
+        формат, обрезан) и его надо перестроить.
+        """
+        journal = journal_file()
+        if os.path.isfile(journal) and os.path.getsize(journal) > 0:
+            size = os.path.getsize(journal)
+            with open(journal, "rb") as f:
+                f.seek(max(size - 4096, 0))
+                tail = f.read().decode("utf-8", "replace").splitlines()
+            entry = _parse_entry(tail[-1]) if tail else None
+            return entry if entry is not None else False
+
+        path = index_file()
+        if not os.path.isfile(path) or os.path.getsize(path) == 0:
+            return None
+        with open(path, "rb") as f:
+            header = f.readline().decode("utf-8", "replace")
+        if not header.startswith("#") or not header.endswith("\n"):
+            return False
+        if header == "#\n":
+            return None
+        entry = _parse_entry(header[1:])
+        return entry if entry is not None else False
+
+    def _covered(self, segment: str):
+        """
+        Байт events.csv, до которого индекс заведомо полный, или None, если
+        индекс не сходится с журналом (журнал подменили/урезали).
+        """
+        entry = self._last_entry()
+        if entry is None:
+            return 0
+        if entry is False or entry[0] != segment:
+            return None
+
+        _, user_id, offset, length = entry
+        events_path = os.path.join(self.profile.logs_dir, segment)
+        try:
+            with open(events_path, "rb") as f:
+                f.seek(offset)
+                line = f.read(length)
+        except OSError:
+            return None
+        if len(line) != length or not line.endswith(b"\n") or _line_user_id(line) != user_id:
+            return None
+        return offset + length
+
+    def _catch_up_locked(self):
+        """Дописывает в журнал индекса строки events.csv, которых в нём ещё нет."""
+        events_path = events_file()
+        segment = os.path.basename(events_path)
+        if not os.path.isfile(events_path):
+            return
+
+        covered = self._covered(segment)
+        rebuild = covered is None
+        if rebuild:
+            covered = 0
+
+        added = []
+        with open(events_path, "rb") as src:
+            src.seek(covered)
+            offset = covered
+            for line in iter(src.readline, b""):
+                length = len(line)
+                if not line.endswith(b"\n"):
+                    # Строку ещё дописывают — проиндексируем в следующий раз
+                    break
+                if offset > 0 or not line.startswith(b"timestamp;"):
+                    user_id = _line_user_id(line)
+                    if user_id:
+                        added.append((segment, user_id, offset, length))
+                offset += length
+
+        if rebuild:
+            # Индекс не сходится с журналом — строим заново
+            last = added[-1] if added else None
+            added.sort(key=lambda e: (e[1], e[0], e[2]))
+            _write_atomic(index_file(), (_format_sorted(u, s, o, n) for s, u, o, n in added), _header(last))
+            _write_atomic(journal_file(), ())
+        elif added:
+            with open(journal_file(), "a", encoding="utf-8") as f:
+                for entry in added:
+                    f.write(_format_entry(*entry))
+
+    def _compact_locked(self, force: bool = False):
+        """Сливает журнал в отсортированный индекс (слиянием, без загрузки индекса в память)."""
+        journal = journal_file()
+        if not os.path.isfile(journal):
+            return
+        size = os.path.getsize(journal)
+        if size == 0 or (not force and size < JOURNAL_MAX_BYTES):
+            return
+
+        entries = self._journal_entries()
+        if not entries:
+            _write_atomic(journal, ())
+            return
+        last = entries[-1]
+        entries.sort(key=lambda e: (e[1], e[0], e[2]))
+        fresh = (_format_sorted(u, s, o, n) for s, u, o, n in entries)
+
+        path = index_file()
+        with open(path, "a+b") as base:
+            base.seek(0)
+            base.readline()  # заголовок
+            merged = heapq.merge(base, fresh, key=_sort_key)
+            _write_atomic(path, _unique(merged), _header(last))
+        # Если упадём здесь, записи окажутся и в индексе, и в журнале —
+        # дубликаты отсекаются при слиянии и поиске
+        _write_atomic(journal, ())
+
+    def _journal_entries(self) -> list:
+        path = journal_file()
+        if not os.path.isfile(path):
+            return []
+        out = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                entry = _parse_entry(line)
+                if entry is not None:
+                    out.append(entry)
+        return out
+
+    def catch_up(self):
+        with use_profile(self.profile):
+            with events_lock():
+                with self._lock:
+                    self._catch_up_locked()
+                    self._compact_locked()
+
+    # --- Поиск ---
+
+    def _lookup_locked(self, user_id: str) -> list:
+        """EventLocation пользователя: двоичный поиск по индексу + журнал."""
+        found = set()
+        path = index_file()
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                f.readline()  # заголовок
+                start = f.tell()
+                f.seek(_find_user(f, start, os.path.getsize(path), user_id))
+                for line in iter(f.readline, b""):
+                    entry = _parse_sorted(line)
+                    if entry is None or entry[0] < user_id:
+                        continue
+                    if entry[0] != user_id:
+                        break
+                    found.add((entry[1], entry[2], entry[3]))
+
+        for segment, uid, offset, length in self._journal_entries():
+            if uid == user_id:
+                found.add((segment, offset, length))
+        return [EventLocation(*loc) for loc in sorted(found)]
+
+    def locations(self, user_id) -> list:
+        """Все EventLocation пользователя в порядке записи."""
+        user_id = str(user_id)
+        with use_profile(self.profile):
+            with events_lock():
+                with self._lock:
+                    self._catch_up_locked()
+                    self._compact_locked()
+                    return self._lookup_locked(user_id)
+
+    # --- Запись вместе с log_event ---
+
+    def on_event(self, row, location=None):
+        """Слушатель storage.log_event: дописывает строку в журнал индекса."""
+        if location is None or current_profile() is not self.profile:
+            return
+        with self._lock:
+            with open(journal_file(), "a", encoding="utf-8") as f:
+                f.write(_format_entry(location.segment, row.user_id, location.offset, location.length))
+
+    def attach(self):
+        """Догоняет индекс и подписывается на новые события."""
+        self.catch_up()
+        add_event_listener(self.on_event)
+
+    # --- Лента и удаление ---
+
+    def timeline(self, user_id) -> list:
+        """События пользователя (EventRecord) в порядке записи."""
+        out = []
+        handles = {}
+        try:
+            for loc in self.locations(user_id):
+                f = handles.get(loc.segment)
+                if f is None:
+                    f = handles[loc.segment] = open(
+                        os.path.join(self.profile.logs_dir, loc.segment), "rb"
+                    )
+                f.seek(loc.offset)
+                record = _parse_line(f.read(loc.length))
+                if record is not None:
+                    out.append(record)
+        finally:
+            for f in handles.values():
+                f.close()
+        return out
+
+    def purge(self, user_id) -> int:
+        """
+        Удаляет все данные пользователя:
+            - его строки из сегментов журнала (переписываются только
+              сегменты, где он есть; куски между его строками копируются
+              как есть, без разбора);
+            - запись из users.json;
+            - user_id из множеств meta и из stats.json (processed_events
+              сдвигается на число удалённых уже учтённых строк).
+        users.json меняется раньше, чем перестраивается stats.json, — иначе
+        его запись попала бы в users_raw. Возвращает число удалённых строк
+        журнала.
+        """
+        user_id = str(user_id)
+        removed_total = 0
+        with use_profile(self.profile):
+            with events_lock():
+                with self._lock:
+                    self._catch_up_locked()
+                    self._compact_locked(force=True)
+                    by_segment = {}
+                    for loc in self._lookup_locked(user_id):
+                        by_segment.setdefault(loc.segment, []).append((loc.offset, loc.length))
+
+                    main_segment = os.path.basename(events_file())
+                    with stats_lock():
+                        processed = max(int(_load_prev_meta().get("processed_events", 0) or 0), 0)
+                        removed_rows = 0
+                        removed_events = []
+                        for segment, ranges in by_segment.items():
+                            ranges.sort()
+                            rows, events = self._rewrite_segment(segment, ranges, processed)
+                            removed_total += len(ranges)
+                            if segment == main_segment:
+                                removed_rows += rows
+                                removed_events.extend(events)
+                        if by_segment:
+                            self._shift_index(user_id, by_segment, main_segment)
+                        remove_user(user_id)
+                        forget_user(user_id, removed_rows, removed_events)
+        return removed_total
+
+    def _rewrite_segment(self, segment: str, ranges: list, processed: int):
+        """
+        Копирует сегмент без строк ranges (отсортированы по смещению) и
+        атомарно подменяет файл. Возвращает (число, события) удалённых строк
+        из первых processed строк с данными — их уже учёл build_stats.
+        """
+        path = os.path.join(self.profile.logs_dir, segment)
+        removed_rows = 0
+        removed_events = []
+        # Номер строки с данными = число переводов строки до неё (заголовок —
+        # строка 0). Пустых строк log_event не пишет.
+        lines_before = 0
+
+        fd, tmp_path = tempfile.mkstemp(prefix=".events-", suffix=".tmp", dir=self.profile.logs_dir)
+        try:
+            with open(path, "rb") as src, os.fdopen(fd, "wb") as dst:
+                position = 0
+                for offset, length in ranges:
+                    remaining = offset - position
+                    while remaining > 0:
+                        chunk = src.read(min(COPY_CHUNK, remaining))
+                        if not chunk:
+                            break
+                        dst.write(chunk)
+                        lines_before += chunk.count(b"\n")
+                        remaining -= len(chunk)
+                    line = src.read(length)
+                    position = offset + length
+                    if lines_before <= processed:
+                        removed_rows += 1
+                        record = _parse_line(line)
+                        if record is not None:
+                            removed_events.append(record)
+                    lines_before += 1
+                while True:
+                    chunk = src.read(COPY_CHUNK)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+            os.replace(tmp_path, path)
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        return removed_rows, removed_events
+
+    def _shift_index(self, user_id: str, by_segment: dict, main_segment: str):
+        """
+        Переписывает индекс (журнал к этому моменту пуст) потоком: без строк
+        пользователя и со сдвинутыми смещениями остальных. Порядок строк не
+        меняется — смещения внутри сегмента сдвигаются монотонно.
+        """
+        shifts = {}
+        for segment, ranges in by_segment.items():
+            removed_before = [0]
+            for _, length in ranges:
+                removed_before.append(removed_before[-1] + length)
+            shifts[segment] = ([offset for offset, _ in ranges], removed_before)
+
+        def rows(src):
+            for line in src:
+                entry = _parse_sorted(line)
+                if entry is None or entry[0] == user_id:
+                    continue
+                uid, segment, offset, length = entry
+                shift = shifts.get(segment)
+                if shift is not None:
+                    starts, removed_before = shift
+                    offset -= removed_before[bisect_left(starts, offset)]
+                yield _format_sorted(uid, segment, offset, length)
+
+        path = index_file()
+        with open(path, "rb") as src:
+            src.readline()  # заголовок
+            _write_atomic(path, rows(src), _header(self._tail_entry(main_segment)))
+
+    def _tail_entry(self, segment: str):
+        """Запись индекса для последней строки сегмента (None — строк нет)."""
+        path = os.path.join(self.profile.logs_dir, segment)
+        size = os.path.getsize(path)
+        if size == 0:
+            return None
+        with open(path, "rb") as f:
+            # Ищем начало последней строки, читая файл с конца кусками
+            end = size - 1
+            pos = end
+            while pos > 0:
+                step = min(COPY_CHUNK, pos)
+                f.seek(pos - step)
+                found = f.read(step).rfind(b"\n")
+                if found >= 0:
+                    pos = pos - step + found + 1
+                    break
+                pos -= step
+            f.seek(pos)
+            line = f.read(size - pos)
+        if pos == 0 or not line.endswith(b"\n"):
+            return None
+        user_id = _line_user_id(line)
+        if not user_id:
+            return None
+        return segment, user_id, pos, len(line)
+
+
+def _sort_key(line: bytes):
+    entry = _parse_sorted(line)
+    if entry is None:
+        return ("", "", -1)
+    return entry[0], entry[1], entry[2]
+
+
+def _unique(lines):
+    """Пропускает повторы соседних строк (одна запись в индексе и в журнале)."""
+    previous = None
+    for line in lines:
+        if line != previous and _parse_sorted(line) is not None:
+            yield line
+        previous = line
+
+
+def _find_user(f, start: int, size: int, user_id: str) -> int:
+    """
+    Двоичный поиск по отсортированному индексу: начало первой строки с
+    user_id >= искомого (строки разной длины — ищем по байтам и
+    выравниваемся на следующую строку).
+    """
+    lo, hi = start, size
+    while lo < hi:
+        mid = (lo + hi) // 2
+        f.seek(mid)
+        if mid > start:
+            f.readline()
+        pos = f.tell()
+        line = f.readline()
+        entry = _parse_sorted(line) if line else None
+        if not line or (entry is not None and entry[0] >= user_id):
+            hi = mid
+        else:
+            lo = pos + len(line)
+    return lo
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Лента событий и удаление данных пользователя")
+    parser.add_argument("--bot", default="", help="имя бота из bots.json")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("timeline", help="показать события пользователя").add_argument("user_id")
+    sub.add_parser("purge", help="удалить все данные пользователя").add_argument("user_id")
+    sub.add_parser("rebuild", help="перестроить индекс с нуля")
+    args = parser.parse_args(argv)
+
+    profile = get_profile(args.bot)
+    with use_profile(profile):
+        index = UserEventIndex(profile)
+        if args.command == "timeline":
+            for ev in index.timeline(args.user_id):
+                print(";".join(ev))
+        elif args.command == "purge":
+            removed = index.purge(args.user_id)
+            print(f"Удалено строк журнала: {removed}")
+        elif args.command == "rebuild":
+            for path in (index_file(), journal_file()):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            index.catch_up()
+            print("Индекс перестроен")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,11 +4,11 @@
 import os
 import json
 import shutil
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from operator import itemgetter
 from datetime import datetime
 
-from config import DATA_DIR, LOGS_DIR
-from storage import EVENTS_FILE, USERS_FILE
+from storage import EVENT_FIELDS, EVENTS_HEADER, EventRecord, events_file, users_file
 
 
 def _ts():
@@ -46,74 +46,150 @@ def safe_load_json(path: str, default):
         return default
 
 
+_RECORD_TYPES = {}
+
+
+def _record_type(fields: tuple):
+    """namedtuple под набор колонок (кэшируется, создаётся один раз)."""
+    if fields == EVENT_FIELDS:
+        return EventRecord
+    rtype = _RECORD_TYPES.get(fields)
+    if rtype is None:
+        rtype = _RECORD_TYPES[fields] = namedtuple("EventProjection", fields)
+    return rtype
+
+
+class EventStream:
+    """
+    Потоковое чтение events.csv: строки читаются и отдаются по одной, в
+    памяти не копится список событий.
+
+        stream = EventStream(skip_rows=100, fields=("user_id", "event"))
+        for ev in stream:
+            ...
+        stream.total_rows  # число строк с данными (без заголовка)
+
+    Параметры:
+        skip_rows — пропустить первые N строк с данными (уже обработанные);
+        fields — проекция: какие колонки нужны. Записи — namedtuple только
+                 с этими полями, строка режется не дальше последней нужной
+                 колонки;
+        since / until — фильтр по timestamp (ISO-строки, границы включены).
+                 until — верхняя граница по префиксу: until="2026-10-19"
+                 включает весь этот день, "2026-10-19T12:00" — всю эту
+                 минуту. Файл пишется по времени, поэтому на первой строке
+                 позже until чтение останавливается.
+
+    total_rows корректен после полного прохода; при досрочной остановке
+    по until (stopped_early=True) он считает только прочитанные строки.
+    Если файл не читается, он, как и раньше, уходит в бэкап и создаётся
+    заново, а corrupted становится True.
+    """
+
+    def __init__(self, skip_rows: int = 0, fields=None, since: str = "", until: str = ""):
+        self.skip_rows = max(int(skip_rows or 0), 0)
+        self.fields = tuple(fields) if fields else EVENT_FIELDS
+        unknown = set(self.fields) - set(EVENT_FIELDS)
+        if unknown:
+            raise ValueError(f"Неизвестные колонки events.csv: {', '.join(sorted(unknown))}")
+        self.since = since or ""
+        self.until = until or ""
+        # Любой timestamp с префиксом until меньше until + "\uffff"
+        self._until_bound = self.until + "\uffff" if self.until else ""
+        self.total_rows = 0
+        self.stopped_early = False
+        self.corrupted = False
+
+    def __iter__(self):
+        self.total_rows = 0
+        self.stopped_early = False
+        self.corrupted = False
+
+        path = events_file()
+        if not os.path.isfile(path):
+            return
+
+        rtype = _record_type(self.fields)
+        indexes = [EVENT_FIELDS.index(name) for name in self.fields]
+        make = rtype._make
+        if len(indexes) == 1:
+            # itemgetter с одним индексом отдаёт значение, а не кортеж
+            single = indexes[0]
+
+            def pick(parts):
+                return (parts[single],)
+        else:
+            pick = itemgetter(*indexes)
+        # Последняя колонка (extra) забирает остаток строки целиком
+        min_seps = len(EVENT_FIELDS) - 1
+        max_split = min(max(indexes) + 1, min_seps)
+        since, until = self.since, self._until_bound
+        skip_rows = self.skip_rows
+
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                header = True
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    if header:
+                        header = False
+                        continue
+
+                    self.total_rows += 1
+                    if self.total_rows <= skip_rows:
+                        continue
+
+                    if line.count(";") < min_seps:
+                        # Пропускаем битую строку
+                        continue
+
+                    if since or until:
+                        ts = line.split(";", 1)[0]
+                        if since and ts < since:
+                            continue
+                        if until and ts > until:
+                            self.stopped_early = True
+                            return
+
+                    yield make(pick(line.split(";", max_split)))
+        except Exception:
+            # Бэкап битого файла и пустой файл вместо него
+            _backup_file(path, "corrupt")
+            try:
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(EVENTS_HEADER)
+            except Exception:
+                pass
+            self.total_rows = 0
+            self.corrupted = True
+
+
 def read_events(skip_rows: int = 0):
     """
     Читает events.csv и возвращает (events, total_rows), где total_rows — число
     строк с данными (без заголовка). Можно пропускать первые skip_rows, чтобы
     обрабатывать только новые события.
-    """
-    events = []
-    total_rows = 0
-    if not os.path.isfile(EVENTS_FILE):
-        return events, total_rows
 
-    try:
-        with open(EVENTS_FILE, "r", encoding="utf-8") as f:
-            header = True
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-                if header:
-                    header = False
-                    continue
-
-                total_rows += 1
-                if total_rows <= skip_rows:
-                    continue
-
-                parts = line.split(";")
-                if len(parts) < 9:
-                    # Пропускаем битую строку
-                    continue
-
-                ts, chat_id, user_id, ev, platform, theme, lead_type, creative, extra = parts
-                events.append(
-                    {
-                        "timestamp": ts,
-                        "chat_id": chat_id,
-                        "user_id": user_id,
-                        "event": ev,
-                        "platform": platform,
-                        "theme": theme,
-                        "lead_type": lead_type,
-                        "creative": creative,
-                        "extra": extra,
-                    }
-                )
-    except Exception:
-        # Бэкап битого файла и возврат пустого списка
-        _backup_file(EVENTS_FILE, "corrupt")
-        try:
-            with open(EVENTS_FILE, "w", encoding="utf-8") as f:
-                f.write(
-                    "timestamp;chat_id;user_id;event;"
-                    "platform;theme;lead_type;creative;extra\n"
-                )
-        except Exception:
-            pass
+    Собирает все события в список dict — для больших файлов лучше
+    итерироваться по EventStream.
+    """
+    stream = EventStream(skip_rows=skip_rows)
+    events = [ev._asdict() for ev in stream]
+    if stream.corrupted:
         return [], 0
-
-    return events, total_rows
+    return events, stream.total_rows
 
 
 def read_users():
     """
     Читает users.json безопасно, при ошибке делает бэкап и возвращает {}.
     """
-    if not os.path.isfile(USERS_FILE):
+    path = users_file()
+    if not os.path.isfile(path):
         return {}
-    data = safe_load_json(USERS_FILE, {})
+    data = safe_load_json(path, {})
     if isinstance(data, dict):
         return data
     return {}